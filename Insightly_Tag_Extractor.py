@@ -4,6 +4,11 @@
 # Created by Jeff Mitchell
 # Pulls out the status tag for each student from Insightly Data dump
 # Insightly Report is 'Contact Tag List'
+# Run with arguments (see --help) to extract without the menu and prompts
+# Run with --serve to accept extraction jobs over HTTP on localhost
+# Run with --import-times to see how long the program takes to start
+# Run the history mode to add dumps to the Status History, and the timeline
+# and counts modes to query it
 
 # To Do:
 
@@ -11,26 +16,1276 @@
 
 
 
-import custtools.admintools as ad
-import custtools.filetools as ft
+import time
+MODULE_STARTED = time.perf_counter()
+import argparse
+import collections
+import contextlib
+import functools
+import glob
+import hashlib
+import hmac
+import importlib.util
+import itertools
+import json
+import os
+import pickle
 import re
 import sys
-import pandas as pd
+import threading
+try:
+    import resource
+except ImportError: # Not available on Windows
+    resource = None
 
 
-def check_existing_students(report_data):
-    """Return list of warnings for information in Existing students data.
+def lazy_import(name):
+    """Return a module that is only imported when it is first used.
+
+    Used for the modules that are slow to import, so that the menu appears
+    straight away and they are only imported when an extraction runs.
+
+    Args:
+        name (str): Full name of the module.
+
+    Returns:
+        module: The module, imported when one of its attributes is used.
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ModuleNotFoundError('No module named {}'.format(name),
+                                  name=name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+
+ad = lazy_import('custtools.admintools')
+futures = lazy_import('concurrent.futures')
+ft = lazy_import('custtools.filetools')
+cProfile = lazy_import('cProfile')
+np = lazy_import('numpy')
+pd = lazy_import('pandas')
+sqlite3 = lazy_import('sqlite3')
+tracemalloc = lazy_import('tracemalloc')
+
+# Modules whose import time is reported by --import-times, in import order
+STARTUP_MODULES = ('numpy', 'pandas', 'custtools.admintools',
+                   'custtools.filetools', 'concurrent.futures', 'sqlite3',
+                   'cProfile', 'tracemalloc', 'http.server', 'xlsxwriter',
+                   'pyarrow')
+
+
+# Status tags in order of priority, with the value returned for each
+STATUS_TAGS = (('suspended', 'Suspended'), ('withdrawn', 'Withdrawn'),
+               ('graduated', 'Graduated'), ('expired', 'Expired'),
+               ('on hold', 'On Hold'), ('cancelled', 'Cancelled'),
+               ('green', 'Green'), ('orange', 'Orange'), ('red', 'Red'),
+               ('black', 'Black'), ('purple', 'Purple'))
+
+# Ways of matching keywords to the Contact tags. 'token' compares each
+# keyword with the whole tags in the list, 'substring' finds keywords
+# anywhere in the tag data, as in earlier versions
+TAG_MATCH_MODES = ('token', 'substring')
+DEFAULT_TAG_MATCH = 'token'
+
+# Separates the tags in the Tags field of the Insightly data
+TAG_SEPARATOR = ','
+
+# Tags that mark a student as no longer active
+INACTIVE_TAGS = ('withdrawn', 'expired', 'graduated', 'transferred')
+
+# Valid values for the Tag column of the Existing Students data
+VALID_TAGS = ('n/a', 'green', 'orange', 'red', 'black', 'purple', 'suspended',
+              'withdrawn', 'graduated', 'expired', 'on hold', 'cancelled')
+
+# Most keys kept as a sample of the students with each kind of issue,
+# and most students with each kind of issue listed in the details
+MAX_DIAGNOSTIC_SAMPLES = 20
+MAX_DIAGNOSTIC_DETAILS = 1000
+
+# Number of rows read at a time when streaming large files
+STREAM_CHUNK_SIZE = 50000
+
+# Formats that tables can be saved in, by file extension
+OUTPUT_FORMATS = ('csv', 'xlsx', 'parquet', 'feather')
+
+# Format used when no output file name or format is given
+DEFAULT_OUTPUT_FORMAT = 'xlsx'
+
+# Number of rows (including headings) that an xlsx worksheet can hold
+XLSX_MAX_ROWS = 1048576
+
+# Number of rows passed to the output writer at a time
+WRITE_CHUNK_SIZE = 50000
+
+# Folder used to cache the cleaned input data between runs
+CACHE_DIR = '.insightly_cache'
+
+# Largest total size of the cache before the least recently used entries
+# are removed
+CACHE_MAX_BYTES = 2 * 1024 ** 3
+
+# Changed whenever the format of the cached data changes
+CACHE_VERSION = 6
+
+# Number of Contacts classified by each worker process at a time
+SHARD_SIZE = 50000
+
+# SQLite database holding the tags extracted by the last incremental run
+TAG_STORE = 'insightly_tags.db'
+
+# SQLite database holding the tags extracted from every Insightly Data dump
+# added to the Status History
+HISTORY_STORE = 'insightly_history.db'
+
+# Address the extraction service listens on. Only local connections are
+# accepted
+SERVICE_HOST = '127.0.0.1'
+SERVICE_PORT = 8765
+
+# Host names a request to the extraction service may be addressed to
+SERVICE_HOST_NAMES = ('127.0.0.1', 'localhost')
+
+# Header holding the token printed when the extraction service starts,
+# which must be sent with every request
+SERVICE_TOKEN_HEADER = 'X-Extraction-Token'
+
+# Number of loaded input files kept in memory by the extraction service
+MEMORY_CACHE_ENTRIES = 4
+
+# Stages of the status, tutor, course, all and views extractions. title
+# names the extraction in messages, view is the name of the table saved,
+# files are the files the user is asked to have ready, and columns are the
+# extracted tags that are saved. A single extracted tag is saved in the
+# Tags column, as in earlier versions. The course codes and tutor names
+# are only loaded if their tag is extracted. saves, if given, are the
+# extractions whose tables are projected from the extracted tags and
+# saved, instead of a single table
+EXTRACTIONS = {
+    'status': {'title': 'Student Status Tags', 'view': 'Status_Tags',
+               'files': ['Existing Students', 'Insightly Data'],
+               'columns': ['Status']},
+    'tutor': {'title': 'Student Tutor Tags', 'view': 'Tutor_Tags',
+              'files': ['Existing Students', 'Insightly Data', 'Tutor Tags'],
+              'columns': ['Tutor']},
+    'course': {'title': 'Student Course Tags', 'view': 'Course_Tags',
+               'files': ['Existing Students', 'Insightly Data',
+                         'Course Codes'],
+               'columns': ['Course']},
+    'all': {'title': 'All Student Tags', 'view': 'All_Tags',
+            'files': ['Existing Students', 'Insightly Data', 'Course Codes',
+                      'Tutor Tags'],
+            'columns': ['Course', 'Tutor', 'Status']},
+    'views': {'title': 'Status, Tutor, Course and All Student Tags',
+              'view': 'All_Tags',
+              'files': ['Existing Students', 'Insightly Data',
+                        'Course Codes', 'Tutor Tags'],
+              'columns': ['Course', 'Tutor', 'Status'],
+              'saves': ['status', 'tutor', 'course', 'all']},
+    }
+
+# Extraction modes available from the command line
+MODES = ('status', 'tutor', 'course', 'all', 'stream', 'views',
+         'incremental', 'history', 'timeline', 'counts', 'reconcile')
+
+
+class TagMatcher:
+    """Classify a Contact tag string in a single scan.
+
+    Each keyword knows which categories it belongs to and its priority
+    within them, so the first keyword in each list that is found is
+    returned, as with the original per-keyword searches.
+
+    By default the Tags are split into separate tags, and a keyword only
+    matches a whole tag, so 'Red' no longer matches inside 'Referral'. The
+    tags of a column are looked up in a tag index rather than searched.
+    With substring matching, all of the keywords are instead compiled into
+    one trie-shaped pattern that reports the longest keyword starting at
+    each position, and keywords are found anywhere in the Tags.
+
+    Keywords are matched case-insensitively. Columns of results are returned
+    as Categoricals, with a fixed set of categories for each matcher.
+    """
+
+    def __init__(self, courses=(), tutors=(), match=DEFAULT_TAG_MATCH):
+        """Compile the matcher for the given courses and tutors.
+
+        Args:
+            courses (list): Course codes in order of priority.
+            tutors (list): Tutor names in order of priority.
+            match (str): 'token' to match keywords to whole tags, or
+            'substring' to find them anywhere in the Tags.
+        """
+        if match not in TAG_MATCH_MODES:
+            raise ValueError('Unknown tag match {}'.format(match))
+        self.match = match
+        categories = {
+            'Status': STATUS_TAGS,
+            'Inactive': [(tag, True) for tag in INACTIVE_TAGS],
+            'Tutor': [(tutor, tutor) for tutor in tutors],
+            'Course': [(course, course) for course in courses],
+            }
+        self.defaults = {'Course': 'N/A', 'Status': 'N/A', 'Tutor': 'N/A',
+                         'Inactive': False}
+        # An empty keyword matches every string, but never a whole tag
+        self.always = {}
+        outputs = {}
+        for category, entries in categories.items():
+            for priority, (keyword, value) in enumerate(entries):
+                keyword = keyword.lower()
+                if match == 'token':
+                    keyword = keyword.strip()
+                if keyword == '':
+                    if match == 'substring' and category not in self.always:
+                        self.always[category] = (priority, value)
+                    continue
+                outputs.setdefault(keyword, []).append((category, priority,
+                                                        value))
+        keywords = sorted(outputs, key=len, reverse=True)
+        if match == 'token':
+            self.hits = outputs
+        else:
+            # A keyword found at a position also implies every keyword that
+            # is a prefix of it, as only the longest alternative is reported
+            # there
+            self.hits = {}
+            for keyword in keywords:
+                self.hits[keyword] = [hit for other in keywords
+                                      if keyword.startswith(other)
+                                      for hit in outputs[other]]
+        # Best priority of each keyword within each category, and the value
+        # for each priority, for classifying whole columns at once
+        self.ranks = {category: {} for category in categories}
+        for keyword, hits in self.hits.items():
+            for category, priority, value in hits:
+                ranks = self.ranks[category]
+                if keyword not in ranks or priority < ranks[keyword]:
+                    ranks[keyword] = priority
+        self.values = {category: [value for keyword, value in entries]
+                       for category, entries in categories.items()}
+        # Categories of each column, and the category code for each
+        # priority, with the default stored last
+        self.categories = {}
+        self.codes = {}
+        for category in ('Course', 'Status', 'Tutor'):
+            values = self.values[category] + [self.defaults[category]]
+            codes = {}
+            for value in values:
+                codes.setdefault(value, len(codes))
+            self.categories[category] = list(codes)
+            self.codes[category] = np.array([codes[value] for value in
+                                             values], dtype=np.int32)
+        if keywords and match == 'substring':
+            self.pattern = re.compile('(?=({}))'.format(
+                    self.build_trie_pattern(keywords)))
+        else:
+            self.pattern = None
+
+    @staticmethod
+    def build_trie_pattern(keywords):
+        """Return a regular expression matching the keywords as a trie.
+
+        Keywords sharing a prefix are factored together so that only the
+        branches for the current character are tried at each position,
+        rather than every keyword in turn. Longer keywords are preferred.
+
+        Args:
+            keywords (list): Keywords to be matched.
+
+        Returns:
+            pattern (str): Regular expression for the keywords.
+        """
+        trie = {}
+        for keyword in keywords:
+            node = trie
+            for char in keyword:
+                node = node.setdefault(char, {})
+            node[''] = True
+
+        def emit(node):
+            branches = [re.escape(char) + emit(node[char])
+                        for char in sorted(node) if char != '']
+            if not branches:
+                return ''
+            if len(branches) == 1:
+                body = branches[0]
+            else:
+                body = '(?:{})'.format('|'.join(branches))
+            if '' in node:
+                return '(?:{})?'.format(body)
+            return body
+
+        return emit(trie)
+
+    def classify_series(self, tags):
+        """Return the Course, Status, Tutor and Inactive columns for Tags.
+
+        The whole column is classified at once. With token matching, the
+        Tags are split into a tag index once and each keyword is looked up
+        in it. With substring matching, the column is lowercased once,
+        every keyword occurrence is found in a single pass and the best
+        priority for each category is then taken with a groupby over the
+        matches.
+
+        Args:
+            tags (Series): Contact tag data for each student.
+
+        Returns:
+            found (DataFrame): Course, Status and Tutor Categorical columns
+            and a boolean Inactive column, aligned with the index of tags.
+        """
+        if self.match == 'token':
+            return self.classify_index(build_tag_index(tags), tags.index)
+        positions = pd.Series(tags.values, dtype=object).str.lower()
+        if self.pattern is not None:
+            matches = positions.str.findall(self.pattern).explode().dropna()
+        else:
+            matches = pd.Series([], dtype=object)
+        best = {}
+        for category in self.ranks:
+            ranks = matches.map(self.ranks[category]).dropna()
+            best[category] = ranks.groupby(level=0).min().reindex(
+                    range(len(positions))).to_numpy(dtype=float)
+            if category in self.always:
+                best[category] = np.fmin(best[category],
+                                         self.always[category][0])
+        return self.to_frame(best, tags.index)
+
+    def classify_index(self, index, row_index):
+        """Return the Course, Status, Tutor and Inactive columns for a tag
+        index.
+
+        Args:
+            index (dict): Positions of the Contacts with each tag, as
+            returned by build_tag_index.
+            row_index (Index): Index of the Contacts.
+
+        Returns:
+            found (DataFrame): Course, Status and Tutor Categorical columns
+            and a boolean Inactive column, aligned with row_index.
+        """
+        best = {}
+        for category, ranks in self.ranks.items():
+            best[category] = np.full(len(row_index), np.nan)
+            for keyword, priority in ranks.items():
+                rows = index.get(keyword)
+                if rows is not None:
+                    best[category][rows] = np.fmin(best[category][rows],
+                                                   priority)
+        return self.to_frame(best, row_index)
+
+    def to_frame(self, best, row_index):
+        """Return the tag columns for the best priority of each Contact.
+
+        Args:
+            best (dict): Best priority found in each category for each
+            Contact, or NaN where nothing was found.
+            row_index (Index): Index of the Contacts.
+
+        Returns:
+            found (DataFrame): Course, Status and Tutor Categorical columns
+            and a boolean Inactive column, aligned with row_index.
+        """
+        found = pd.DataFrame(index=row_index)
+        for category in ('Course', 'Status', 'Tutor', 'Inactive'):
+            # Contacts without a match take the default, stored last
+            best[category] = np.where(
+                    np.isnan(best[category]), len(self.values[category]),
+                    best[category]).astype(int)
+            if category == 'Inactive':
+                found[category] = best[category] < len(
+                        self.values[category])
+            else:
+                found[category] = pd.Categorical.from_codes(
+                        self.codes[category][best[category]],
+                        categories=self.categories[category])
+        return found
+
+    def to_categorical(self, found):
+        """Return extracted tag columns as this matcher's Categoricals.
+
+        Args:
+            found (DataFrame): Course, Status, Tutor and Inactive columns,
+            holding values extracted with this matcher.
+
+        Returns:
+            found (DataFrame): The columns, with Course, Status and Tutor
+            converted to Categoricals.
+        """
+        found = found.copy()
+        for category, categories in self.categories.items():
+            found[category] = pd.Categorical(found[category],
+                                             categories=categories)
+        return found
+
+
+class TableWriter:
+    """Save a table to disk a chunk at a time.
+
+    Chunks are written as they are received, so a table does not need to be
+    held in memory by the writer. Csv is written with pandas, xlsx with the
+    constant memory mode of xlsxwriter and parquet and feather with pyarrow.
+    """
+
+    def __init__(self, f_name, out_format=''):
+        """Prepare to save a table.
+
+        Args:
+            f_name (str): Name of the file to save.
+            out_format (str): (Optional) Format of the file, one of
+            OUTPUT_FORMATS. If not provided, it is taken from the extension
+            of f_name.
+        """
+        if out_format in (None, ''):
+            out_format = os.path.splitext(f_name)[1].lstrip('.').lower()
+        if out_format not in OUTPUT_FORMATS:
+            raise ValueError('Unknown output format for {}. Please use one '
+                             'of {}.'.format(f_name, ', '.join(
+                                     OUTPUT_FORMATS)))
+        self.f_name = f_name
+        self.out_format = out_format
+        self.rows = 0
+        self.handle = None
+        self.sheet = None
+        self.schema = None
+
+    def close(self):
+        """Finish saving the table."""
+        if self.handle is not None:
+            self.handle.close()
+        self.handle = None
+
+    def write(self, frame):
+        """Append a chunk of rows to the table.
+
+        Args:
+            frame (DataFrame): Rows to save. The first chunk sets the column
+            headings.
+        """
+        if self.out_format == 'csv':
+            header = self.handle is None
+            if header:
+                self.handle = open(self.f_name, 'w', newline='',
+                                   encoding='utf-8')
+            frame.to_csv(self.handle, header=header, index=False)
+        elif self.out_format == 'xlsx':
+            import xlsxwriter
+            if self.rows + len(frame) >= XLSX_MAX_ROWS:
+                raise ValueError('Too many rows to save to {}. Please use '
+                                 'csv, parquet or feather.'.format(
+                                         self.f_name))
+            if self.handle is None:
+                self.handle = xlsxwriter.Workbook(
+                        self.f_name, {'constant_memory': True,
+                                      'nan_inf_to_errors': True})
+                self.sheet = self.handle.add_worksheet()
+                self.sheet.write_row(0, 0, list(frame.columns))
+            # Constant memory mode requires rows to be written in order
+            row_number = self.rows + 1
+            for row in frame.itertuples(index=False, name=None):
+                self.sheet.write_row(row_number, 0, row)
+                row_number += 1
+        elif self.out_format in ('parquet', 'feather'):
+            import pyarrow as pa
+            table = pa.Table.from_pandas(frame, schema=self.schema,
+                                         preserve_index=False)
+            if self.handle is None:
+                self.schema = table.schema
+                if self.out_format == 'parquet':
+                    import pyarrow.parquet as pq
+                    self.handle = pq.ParquetWriter(self.f_name, self.schema)
+                else:
+                    # Feather version 2 is the Arrow IPC file format
+                    self.handle = pa.ipc.new_file(self.f_name, self.schema)
+            self.handle.write_table(table)
+        self.rows += len(frame)
+
+
+class RunStats:
+    """Record the time and memory used by each stage of an extraction.
+
+    Stages are timed with the stage context manager. A stage that is
+    entered more than once, such as for each chunk of a streamed file, is
+    added to its earlier total. Peak RSS is the peak memory of the process
+    at the end of the stage, and is not available on Windows. CPU time is
+    measured for the whole process, so stages that run at the same time,
+    such as loading the input files, include each other's CPU time.
+    """
+
+    def __init__(self, profile_stage=''):
+        """Prepare to record the stages of an extraction.
+
+        Args:
+            profile_stage (str): (Optional) Name of a stage to profile with
+            cProfile and tracemalloc.
+        """
+        self.profile_stage = profile_stage
+        self.stages = {}
+        self.profiler = None
+        self.snapshot = None
+        self.started = time.perf_counter()
+
+    def finish(self, f_name, timings=True):
+        """Print and save the stage timings, if wanted.
+
+        Timings are saved as JSON lines to a file named after the output
+        file, along with the profile of the profiled stage.
+
+        Args:
+            f_name (str): Name of the file saved by the extraction.
+            timings (bool): False to do nothing.
+        """
+        if not timings:
+            return
+        total = {'stage': 'total', 'rows_in': None, 'rows_out': None,
+                 'wall_s': time.perf_counter() - self.started,
+                 'cpu_s': sum(stage['cpu_s'] for stage in
+                              self.stages.values()),
+                 'peak_rss_mb': get_peak_rss()}
+        print('\n{:<18}{:>10}{:>10}{:>12}{:>12}{:>14}'.format(
+                'Stage', 'Wall (s)', 'CPU (s)', 'Rows in', 'Rows out',
+                'Peak RSS (MB)'))
+        for stage in list(self.stages.values()) + [total]:
+            print('{:<18}{:>10.3f}{:>10.3f}{:>12}{:>12}{:>14}'.format(
+                    stage['stage'], stage['wall_s'], stage['cpu_s'],
+                    format_optional(stage['rows_in']),
+                    format_optional(stage['rows_out']),
+                    format_optional(stage['peak_rss_mb'], '{:.1f}')))
+        stem = os.path.splitext(f_name)[0]
+        timings_f_name = '{}_timings.jsonl'.format(stem)
+        with open(timings_f_name, 'w') as f:
+            for stage in list(self.stages.values()) + [total]:
+                f.write('{}\n'.format(json.dumps(stage)))
+        print('\nTimings have been saved to {}'.format(timings_f_name))
+        if self.profiler is not None:
+            profile_f_name = '{}_{}.prof'.format(stem, self.profile_stage)
+            self.profiler.dump_stats(profile_f_name)
+            memory_f_name = '{}_{}_memory.txt'.format(stem,
+                                                      self.profile_stage)
+            with open(memory_f_name, 'w') as f:
+                for line in self.snapshot.statistics('lineno')[:25]:
+                    f.write('{}\n'.format(line))
+            print('\nProfile of {} has been saved to {} and {}'.format(
+                    self.profile_stage, profile_f_name, memory_f_name))
+
+    @contextlib.contextmanager
+    def stage(self, name, rows_in=None):
+        """Time a stage of an extraction.
+
+        Args:
+            name (str): Name of the stage.
+            rows_in (int): (Optional) Number of rows passed to the stage.
+
+        Yields:
+            record (dict): Record for this run of the stage, where rows_out
+            can be set.
+        """
+        record = {'rows_out': None}
+        profiling = name == self.profile_stage and self.profiler is None
+        if profiling:
+            tracemalloc.start()
+            profiler = cProfile.Profile()
+            profiler.enable()
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        try:
+            yield record
+        finally:
+            wall = time.perf_counter() - wall
+            cpu = time.process_time() - cpu
+            if profiling:
+                profiler.disable()
+                self.profiler = profiler
+                self.snapshot = tracemalloc.take_snapshot()
+                tracemalloc.stop()
+            stage = self.stages.setdefault(name, {
+                    'stage': name, 'rows_in': None, 'rows_out': None,
+                    'wall_s': 0.0, 'cpu_s': 0.0, 'peak_rss_mb': None})
+            stage['wall_s'] += wall
+            stage['cpu_s'] += cpu
+            stage['peak_rss_mb'] = get_peak_rss()
+            for key, rows in (('rows_in', rows_in),
+                              ('rows_out', record['rows_out'])):
+                if rows is not None:
+                    stage[key] = (stage[key] or 0) + rows
+
+
+class Diagnostics:
+    """Collect the issues found in the data during an extraction.
+
+    Issues are counted by category, and a sample of at most max_samples
+    keys is kept for each category. The keys of at most max_details
+    students are kept for the details of each category, as arrays rather
+    than as messages, so a file with many issues uses little memory. The
+    message for each student is only created when the details are written,
+    a line at a time. Collectors from several files or chunks are combined
+    with update.
+    """
+
+    def __init__(self, title='', max_samples=MAX_DIAGNOSTIC_SAMPLES,
+            max_details=MAX_DIAGNOSTIC_DETAILS):
+        """Prepare to collect issues.
+
+        Args:
+            title (str): (Optional) Heading for the issues.
+            max_samples (int): Most keys kept as a sample for each
+            category.
+            max_details (int): Most students listed in the details of each
+            category.
+        """
+        self.title = title
+        self.max_samples = max_samples
+        self.max_details = max_details
+        self.counts = {}
+        self.messages = {}
+        self.samples = {}
+        self.keys = {}
+
+    def __bool__(self):
+        return len(self.counts) > 0
+
+    @classmethod
+    def from_state(cls, state):
+        """Return a collector from the state of another collector.
+
+        The state is a dict of built-in types and arrays, so it can be
+        cached whether this module is imported or run as a script.
+
+        Args:
+            state (dict): The attributes of the collector, from vars.
+
+        Returns:
+            diagnostics (Diagnostics): The collector.
+        """
+        diagnostics = cls()
+        diagnostics.__dict__.update(state)
+        return diagnostics
+
+    def add(self, category, failed, keys, message):
+        """Record the students that have failed a check.
+
+        Args:
+            category (str): Name of the kind of issue.
+            failed (Series): True for each student that failed the check.
+            keys (Series): Value identifying each student, such as the
+            StudentID.
+            message (str): Message for a student, with a placeholder for
+            the key.
+        """
+        failed_keys = keys.to_numpy(dtype=object)[failed.to_numpy(
+                dtype=bool)]
+        if len(failed_keys) == 0:
+            return
+        self.record(category, failed_keys, message)
+
+    def record(self, category, failed_keys, message, count=None):
+        """Record the keys of students with an issue.
+
+        Args:
+            category (str): Name of the kind of issue.
+            failed_keys (ndarray): Key of each student with the issue.
+            message (str): Message for a student, with a placeholder for
+            the key.
+            count (int): (Optional) Number of students with the issue, if
+            only the first of their keys are given.
+        """
+        if count is None:
+            count = len(failed_keys)
+        kept = min(self.counts.get(category, 0), self.max_details)
+        self.counts[category] = self.counts.get(category, 0) + count
+        self.messages[category] = message
+        samples = self.samples.setdefault(category, [])
+        samples.extend(failed_keys[:self.max_samples - len(samples)].tolist())
+        keys = self.keys.setdefault(category, [])
+        if kept < self.max_details:
+            keys.append(failed_keys[:self.max_details - kept])
+
+    def details(self):
+        """Yield the message for each student listed, by category."""
+        for category, message in self.messages.items():
+            for failed_keys in self.keys[category]:
+                for key in failed_keys:
+                    yield message.format(key)
+            remaining = self.counts[category] - self.max_details
+            if remaining > 0:
+                yield '{} more students: {}'.format(remaining,
+                                                    message.format('...'))
+
+    def summary(self):
+        """Return the number of students and sample keys for each category.
+
+        Returns:
+            lines (list): Lines of the summary, starting with the title.
+        """
+        lines = ['\n{}:\n'.format(self.title)]
+        for category, count in self.counts.items():
+            samples = ', '.join(str(key) for key in self.samples[category])
+            if count > len(self.samples[category]):
+                samples += ' and {} more'.format(
+                        count - len(self.samples[category]))
+            lines.append('{}: {} students ({})'.format(category, count,
+                                                       samples))
+        return lines
+
+    def update(self, other):
+        """Add the issues collected by another collector.
+
+        Args:
+            other (Diagnostics): Collector to add.
+        """
+        for category, message in other.messages.items():
+            failed_keys = np.concatenate(other.keys[category])
+            self.record(category, failed_keys, message,
+                        other.counts[category])
+
+    def write(self, f_name, mode='w'):
+        """Save the summary and then the details of every issue.
+
+        Args:
+            f_name (str): Name of the file to save.
+            mode (str): 'w' to replace the file, or 'a' to add to the end
+            of it.
+        """
+        with open(f_name, mode) as f:
+            for line in self.summary():
+                f.write('{}\n'.format(line))
+            f.write('\nDetails:\n\n')
+            for line in self.details():
+                f.write('{}\n'.format(line))
+
+
+class StudentIndex:
+    """Join extracted Insightly data to the Existing Students by StudentID.
+
+    The Existing Students are indexed by StudentID once, so each join looks
+    up the Insightly StudentIDs in the index rather than merging the two
+    tables. StudentIDs are compared as integers when they are all plain
+    numbers, which is much faster than comparing strings.
+
+    Duplicate StudentIDs in the Existing Students are detected when the
+    index is built. The tables are then merged instead, giving a row for
+    each pair of matching students as before.
+    """
+
+    def __init__(self, exist):
+        """Index the Existing Students by StudentID.
+
+        Args:
+            exist (DataFrame): Enrolment Code, StudentID and optionally Tag
+            for each student in the Student Database.
+        """
+        self.exist = exist
+        self.keys = get_student_keys(exist)
+        if self.keys is None:
+            self.index = pd.Index(exist['StudentID'].to_numpy())
+        else:
+            self.index = pd.Index(self.keys)
+        self.unique = self.index.is_unique
+        # Only built if non-numeric StudentIDs are joined to numeric ones
+        self.text_index = None
+
+    def get_positions(self, insight):
+        """Return the position of each Insightly student in the index.
+
+        Args:
+            insight (DataFrame): Insightly data with a StudentID column.
+
+        Returns:
+            positions (ndarray): Position of the matching Existing Student
+            for each Insightly student, or -1 if there is none.
+        """
+        if self.keys is None: # The index holds the StudentIDs as strings
+            return self.index.get_indexer(insight['StudentID'].to_numpy())
+        keys = get_student_keys(insight)
+        if keys is not None:
+            return self.index.get_indexer(keys)
+        if self.text_index is None:
+            self.text_index = pd.Index(self.exist['StudentID'].to_numpy())
+        return self.text_index.get_indexer(insight['StudentID'].to_numpy())
+
+    def join(self, insight, keep_old, headings, insightly_order=False,
+             mask=None):
+        """Return the Insightly data joined to the Existing Students.
+
+        Only the requested columns of the selected students are copied, so
+        the Insightly data is never copied as a whole.
+
+        Args:
+            insight (DataFrame): Insightly data with the extracted tag
+            columns.
+            keep_old (bool): True to include students that are not in the
+            Student Database.
+            headings (list): Columns to return.
+            insightly_order (bool): True to keep the order of the Insightly
+            data when removing students that are not in the Student
+            Database, rather than the order of the Existing Students.
+            mask (ndarray): (Optional) True for each Insightly student to
+            include. Defaults to every student.
+
+        Returns:
+            tags (DataFrame): The joined data.
+        """
+        if not self.unique:
+            if mask is not None:
+                insight = insight[mask]
+            how = 'right' if keep_old or insightly_order else 'inner'
+            tags = pd.merge(self.exist.drop(columns='StudentKey',
+                                            errors='ignore'),
+                            insight.drop(columns='StudentKey',
+                                         errors='ignore'),
+                            on='StudentID', how=how)
+            if keep_old:
+                tags['Enrolment Code'] = tags['Enrolment Code'].fillna('N/A')
+            elif insightly_order:
+                tags = tags[tags['Enrolment Code'].notna()]
+            return tags[headings].reset_index(drop=True)
+        positions = self.get_positions(insight)
+        if mask is None:
+            rows = np.arange(len(insight))
+        else:
+            rows = np.flatnonzero(mask)
+        if not keep_old: # Remove students not in the Student Database
+            rows = rows[positions[rows] >= 0]
+            if not insightly_order:
+                # As with an inner merge, in the order of the Existing
+                # Students
+                rows = rows[np.argsort(positions[rows], kind='stable')]
+        positions = positions[rows]
+        tags = {}
+        for heading in headings:
+            if heading in insight:
+                tags[heading] = insight[heading].array.take(rows)
+            else:
+                tags[heading] = self.exist[heading].array.take(
+                        positions, allow_fill=True)
+        tags = pd.DataFrame(tags, columns=headings)
+        if keep_old:
+            tags['Enrolment Code'] = tags['Enrolment Code'].fillna('N/A')
+        return tags
+
+
+class ExtractionHandler:
+    """Handle requests to the extraction service.
+
+    POST /jobs runs the job in the JSON body, using the same keys as a
+    manifest job, and returns the names of the files saved. GET /stats
+    returns the latency of the jobs run so far. POST /shutdown stops the
+    service. Jobs are run one at a time, in the order they are received.
+
+    Every request must send the token printed when the service started in
+    the SERVICE_TOKEN_HEADER header, and be addressed to localhost. POST
+    requests must have a JSON body, so a web page cannot send them without
+    the browser first asking the service, which is refused. Jobs can only
+    save files in the output folder of the service.
+
+    Combined with BaseHTTPRequestHandler when the service starts, so that
+    http.server is only imported by the service.
+    """
+
+    def check_request(self, post=False):
+        """Return True if the request is allowed, otherwise refuse it.
+
+        Args:
+            post (bool): True if the request is a POST, which must have a
+            JSON body.
+        """
+        hosts = set(SERVICE_HOST_NAMES) | {
+                '{}:{}'.format(name, self.server.server_port)
+                for name in SERVICE_HOST_NAMES}
+        origin = self.headers.get('Origin')
+        token = self.headers.get(SERVICE_TOKEN_HEADER, '')
+        if self.headers.get('Host') not in hosts:
+            self.send_json(403, {'error': 'Requests must be sent to '
+                                 'localhost'})
+        elif origin is not None and origin not in {
+                'http://{}'.format(host) for host in hosts}:
+            self.send_json(403, {'error': 'Requests from {} are not '
+                                 'allowed'.format(origin)})
+        elif not hmac.compare_digest(token.encode('utf-8'),
+                                     self.server.token.encode('utf-8')):
+            self.send_json(403, {'error': 'Missing or incorrect {} '
+                                 'header'.format(SERVICE_TOKEN_HEADER)})
+        elif post and self.headers.get_content_type() != 'application/json':
+            self.send_json(415, {'error': 'Content-Type must be '
+                                 'application/json'})
+        else:
+            return True
+        return False
+
+    def do_GET(self):
+        if not self.check_request():
+            return
+        if self.path != '/stats':
+            self.send_json(404, {'error': 'Unknown path {}'.format(
+                    self.path)})
+            return
+        latencies = self.server.latencies
+        stats = {'jobs': len(latencies), 'failed': self.server.failed,
+                 'uptime_seconds': time.perf_counter() - self.server.started,
+                 'memory_cache_entries': len(MEMORY_CACHE.entries)}
+        if latencies:
+            ordered = sorted(latencies)
+            stats.update({'last_seconds': latencies[-1],
+                          'mean_seconds': sum(latencies) / len(latencies),
+                          'median_seconds': ordered[len(ordered) // 2],
+                          'max_seconds': ordered[-1]})
+        self.send_json(200, stats)
+
+    def do_POST(self):
+        if not self.check_request(post=True):
+            return
+        if self.path == '/shutdown':
+            self.send_json(200, {'status': 'stopping'})
+            # Shutting down waits for this request, so is done elsewhere
+            threading.Thread(target=self.server.shutdown).start()
+            return
+        if self.path != '/jobs':
+            self.send_json(404, {'error': 'Unknown path {}'.format(
+                    self.path)})
+            return
+        start = time.perf_counter()
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            job = self.prepare_job(json.loads(
+                    self.rfile.read(length).decode('utf-8')))
+            f_name = run_job(job)
+        except ValueError as e:
+            self.server.failed += 1
+            print('\nJob failed: {}'.format(e))
+            self.send_json(400, {'error': str(e)})
+            return
+        except Exception as e:
+            self.server.failed += 1
+            print('\nJob failed: {}'.format(e))
+            self.send_json(500, {'error': '{}: {}'.format(
+                    type(e).__name__, e)})
+            return
+        seconds = time.perf_counter() - start
+        self.server.latencies.append(seconds)
+        if not isinstance(f_name, list):
+            f_name = [f_name]
+        print('\nJob {} saved to {} in {:.2f} seconds'.format(
+                job.get('mode'), ', '.join(f_name), seconds))
+        self.send_json(200, {'mode': job.get('mode'), 'outputs': f_name,
+                             'seconds': seconds})
+
+    def prepare_job(self, job):
+        """Return a job with the service defaults and its files checked.
+
+        The names of the files saved by the job are taken as relative to
+        the output folder of the service, and must be inside it. If no
+        output name is given, a time stamped name in the output folder is
+        used. The service's own cache folder is always used.
+
+        Args:
+            job (dict): Job options, from the request body.
+
+        Returns:
+            job (dict): Job options to run.
+        """
+        if not isinstance(job, dict):
+            raise ValueError('A job must be a JSON object')
+        job = dict(self.server.defaults, **job)
+        job['cache_dir'] = self.server.defaults.get('cache_dir')
+        output_dir = self.server.output_dir
+        for key, default in (('output', ''), ('history', HISTORY_STORE),
+                             ('store', TAG_STORE)):
+            f_name = job.get(key) or default
+            path = os.path.realpath(os.path.join(output_dir, f_name))
+            if os.path.commonpath([output_dir, path]) != output_dir:
+                raise ValueError('{} must be in the output folder {}'.format(
+                        key, output_dir))
+            if os.path.basename(f_name) == '': # Only a folder is given
+                path = os.path.join(path, '')
+            job[key] = path
+        return job
+
+    def send_json(self, status, body):
+        """Send a JSON response.
+
+        Args:
+            status (int): HTTP status code.
+            body (dict): Response to be sent as JSON.
+        """
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class MemoryCache:
+    """Keep the most recently loaded input data in memory.
+
+    Used by the extraction service so that unchanged input files are not
+    even read from the cache folder again. Copies are stored and returned,
+    as extractions add columns to the data they are given. Nothing is kept
+    while the size is 0.
+    """
+
+    def __init__(self, size=0):
+        """Create an empty cache.
+
+        Args:
+            size (int): Most entries to keep.
+        """
+        self.size = size
+        self.entries = collections.OrderedDict()
+
+    @staticmethod
+    def copy(result):
+        """Return a copy of a loader result, copying any tables in it."""
+        return tuple(item.copy() if isinstance(item, (pd.DataFrame, dict))
+                     else item for item in result)
+
+    def get(self, key):
+        """Return a copy of an entry, or None if it is not in the cache.
+
+        Args:
+            key (str): Key of the entry.
+        """
+        if key not in self.entries:
+            return None
+        self.entries.move_to_end(key)
+        return self.copy(self.entries[key])
+
+    def put(self, key, result):
+        """Store a copy of an entry, removing the least recently used.
+
+        Args:
+            key (str): Key of the entry.
+            result (tuple): Loader result to be stored.
+        """
+        if self.size <= 0:
+            return
+        self.entries[key] = self.copy(result)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+
+# Input data kept in memory between jobs by the extraction service
+MEMORY_CACHE = MemoryCache()
+
+# Held while the cache index is updated or cache entries are removed, as
+# the input files of an extraction are loaded in separate threads
+CACHE_LOCK = threading.Lock()
+
+
+def add_errors(found, source, errors=None):
+    """Keep the errors identified in an input file until they are saved.
+
+    Args:
+        found (Diagnostics): Errors that have been identified in the data.
+        source (str): Name of the input file in the error log.
+        errors (list): (Optional) List to add the source and errors to. If
+        not provided, the errors are saved to the error log straight away.
+    """
+    if errors is None:
+        save_errors(found, source)
+    else:
+        errors.append((source, found))
+
+
+def add_student_keys(frame):
+    """Add the StudentIDs of a table as integers, if they are numbers.
+
+    The StudentKey column is only added if every StudentID can be
+    converted, and is then used to join the table by StudentID.
+
+    Args:
+        frame (DataFrame): Table with a StudentID column.
+    """
+    keys = get_student_keys(frame)
+    if keys is not None:
+        frame['StudentKey'] = keys
+
+
+def build_summaries(tags):
+    """Return tables counting the students in the extracted tags.
+
+    The counts are grouped on the categorical tag columns, so every Status
+    and every Tutor or Course of the matcher has a row or column, even if
+    no students have it. Each row of tags is an enrolment, so a student
+    enrolled in more than one course is counted once for each.
+
+    Args:
+        tags (DataFrame): Enrolment Code, StudentID, First Name, Last Name,
+        Course, Tutor and Status for each student.
+
+    Returns:
+        summaries (dict): Status_by_Tutor and Status_by_Course, with a
+        column for each Status and a Total, and Tutor_Workload, with the
+        enrolments, students and courses of each Tutor.
+    """
+    summaries = {}
+    for heading in ('Tutor', 'Course'):
+        counts = tags.groupby([heading, 'Status'], observed=False,
+                              sort=True).size().unstack(fill_value=0)
+        counts.columns = list(counts.columns)
+        counts['Total'] = counts.sum(axis=1)
+        summaries['Status_by_{}'.format(heading)] = counts.reset_index()
+    by_tutor = tags.groupby('Tutor', observed=False, sort=True)
+    workload = pd.DataFrame({
+            'Enrolments': by_tutor.size(),
+            'Students': by_tutor['StudentID'].nunique(),
+            'Courses': tags['Course'].where(tags['Course'] != 'N/A').groupby(
+                    tags['Tutor'], observed=False, sort=True).nunique()})
+    summaries['Tutor_Workload'] = workload.reset_index()
+    return summaries
+
+
+def build_tag_chunks(columns, keep_old, sample, source, exist_f_name='',
+        insightly_f_name='', courses_f_name='courses.txt',
+        tutors_f_name='tutors.txt', cache_dir=CACHE_DIR, workers=1,
+        shard_size=SHARD_SIZE, match=DEFAULT_TAG_MATCH, stats=None,
+        diagnostics=None, chunk_size=None, errors=None):
+    """Yield the chosen tags for each student.
+
+    Runs the stages shared by the extractions. The input files are loaded,
+    validated and cleaned at the same time, the tags are extracted in one
+    pass, inactive students are filtered out if only Active students are
+    wanted, and the result is joined to the Existing Students and yielded
+    as a single table.
+
+    If a chunk size is given, the files are streamed instead, for files too
+    large for memory. The Insightly data is loaded, extracted, filtered and
+    joined a chunk at a time, and each chunk is yielded in the order of the
+    Insightly data rather than the Existing Students. Streamed files are
+    not cached.
+
+    Args:
+        columns (list): Tags to extract, from 'Course', 'Tutor' and
+        'Status', in the order they are returned.
+        keep_old (bool): True to include students that are not in the
+        Student Database.
+        sample (str): 'All' or 'Active' students.
+        source (str): The code for the Existing Students data to be loaded.
+        exist_f_name (str): (Optional) Existing Students file name. If not
+        provided, user will be prompted.
+        insightly_f_name (str): (Optional) Insightly Data file name. If not
+        provided, user will be prompted.
+        courses_f_name (str): Name of the course codes file, loaded if the
+        Course tag is extracted.
+        tutors_f_name (str): Name of the tutor names file, loaded if the
+        Tutor tag is extracted.
+        cache_dir (str): Folder used to cache the cleaned input data, or
+        None to always load the data from the files.
+        workers (int): Number of worker processes used to extract the tags.
+        shard_size (int): Number of students extracted by each worker
+        process at a time.
+        match (str): 'token' to match keywords to whole tags, or
+        'substring' to find them anywhere in the Tags.
+        stats (RunStats): (Optional) Record of the time and memory used by
+        each stage.
+        diagnostics (Diagnostics): (Optional) Collector to add the warnings
+        identified in the data to.
+        chunk_size (int): (Optional) Number of rows to read at a time when
+        streaming the files.
+        errors (list): (Optional) List to add the source and errors of each
+        input file to. If not provided, errors are saved to the error log
+        straight away.
+
+    Yields:
+        tags (DataFrame): Enrolment Code, StudentID, First Name, Last Name
+        and the extracted tags for each student, or for each chunk of
+        students.
+    """
+    if stats is None:
+        stats = RunStats()
+    if 'Course' not in columns:
+        courses_f_name = ''
+    if 'Tutor' not in columns:
+        tutors_f_name = ''
+    if chunk_size is None:
+        # Load, check and clean the Existing Students and Insightly data
+        # and any courses and tutors at the same time
+        exist, insight, courses, tutors = load_inputs(
+                source, exist_f_name, insightly_f_name, courses_f_name,
+                tutors_f_name, cache_dir, stats, diagnostics, errors)
+        chunks = [insight]
+    else:
+        exist, chunks, courses, tutors = load_stream_inputs(
+                source, exist_f_name, insightly_f_name, courses_f_name,
+                tutors_f_name, chunk_size, stats, diagnostics, errors)
+    matcher = get_tag_matcher(tuple(courses or ()), tuple(tutors or ()),
+                              match)
+    headings = ['Enrolment Code', 'StudentID', 'First Name', 'Last Name']
+    students = None
+    for insight in chunks:
+        # Find the tags and whether each student is inactive in one pass,
+        # leaving the Tags as they are
+        with stats.stage('extract', len(insight)) as record:
+            found = classify_tags(insight['Tags'], matcher, workers,
+                                  shard_size)
+            for column in columns:
+                insight[column] = found[column]
+            record['rows_out'] = len(insight)
+        # Remove Expired, Graduated and Withdrawn students if desired
+        active = get_active_mask(found, sample, stats)
+        # Remove Students not in the Student Database, if required
+        with stats.stage('join', len(insight)) as record:
+            if students is None:
+                students = StudentIndex(exist)
+            tags = students.join(insight, keep_old, headings + columns,
+                                 insightly_order=chunk_size is not None,
+                                 mask=active)
+            record['rows_out'] = len(tags)
+        yield tags
+
+
+def build_tag_index(tags):
+    """Return the positions of the Contacts with each tag.
+
+    The Tags of each Contact are split into separate tags, which are
+    lowercased and stripped of whitespace, once for the whole column.
+
+    Args:
+        tags (Series): Contact tag data for each student.
+
+    Returns:
+        index (dict): Array of the positions of the Contacts with each tag,
+        keyed by tag.
+    """
+    split = pd.Series(tags.values, dtype=object).str.lower().str.split(
+            TAG_SEPARATOR).explode().str.strip()
+    split = split[split.notna() & (split != '')]
+    codes, uniques = pd.factorize(split.to_numpy())
+    if len(uniques) == 0:
+        return {}
+    rows = split.index.to_numpy()[np.argsort(codes, kind='stable')]
+    ends = np.cumsum(np.bincount(codes, minlength=len(uniques)))
+    return dict(zip(uniques, np.split(rows, ends[:-1])))
+
+
+def check_existing_students(report_data, diagnostics=None, errors=None):
+    """Record issues with the information in Existing students data.
 
     Checks the Existing students data to see if the required information is
-    present. Missing or incorrect information that is non-fatal is appended to
-    a warnings list and returned.
+    present. Missing or incorrect information that is non-fatal is recorded
+    as a warning in diagnostics, which is returned.
+
+    Each check is applied to a whole column at once, and only the students
+    that fail it are recorded. Errors are summarised in the error log.
 
     Args:
-        report_data (list): Existing students report data.
+        report_data (list): Existing students report data, as a list of rows
+        or a DataFrame.
+        diagnostics (Diagnostics): (Optional) Collector to record warnings
+        in. If not provided, a new collector is created.
+        errors (Diagnostics): (Optional) Collector to record errors in. If
+        not provided, errors are saved to the error log straight away.
 
     Returns:
-        True if warnings list has had items appended to it, False otherwise.
-        warnings (list): Warnings that have been identified in the data.
+        diagnostics (Diagnostics): Warnings that have been identified in the
+        data.
 
     File structure (report_data):
         EnrolmentPK, StudentID, CourseFK, TutorFK, StartDate, ExpiryDate,
@@ -39,50 +1294,61 @@ def check_existing_students(report_data):
     File source (report_data):
         Enrolments Table in Student Database.
     """
-    errors = []
-    i = 0
-    warnings = ['\nExisting Students Data File Warnings:\n']
-    while i < len(report_data):
-        student = report_data[i]
-        if student[1] in (None, ''):
-            errors.append('Student ID is missing for student with the '
-                            'Enrolment Code {}'.format(student[0]))
-        if student[6] in (None, ''):
-            warnings.append('Status is missing for student with the '
-                            'Student ID {}'.format(student[1]))
-        if student[7] in (None, ''):
-            warnings.append('Tag is missing for student with the '
-                            'Student ID {}'.format(student[1]))
-        # Add check that tag is correct
-        if student[7].lower() not in ('n/a', 'green', 'orange', 'red', 'black',
-                  'purple', 'suspended', 'withdrawn', 'graduated', 'expired',
-                  'on hold', 'cancelled'):
-            errors.append('Tag for student with the Student ID {} is not '
-                          'valid.'.format(student[1]))
-        i += 1
+    log_errors = errors is None
+    if log_errors:
+        errors = Diagnostics('Existing Students Data File Errors')
+    if diagnostics is None:
+        diagnostics = Diagnostics('Existing Students Data File Warnings')
+    report = to_report_frame(report_data, 8)
+    enrolments = report.iloc[:, 0].fillna('')
+    students = report.iloc[:, 1].fillna('')
+    errors.add('Student ID missing', students == '', enrolments,
+               'Student ID is missing for student with the Enrolment Code '
+               '{}')
+    diagnostics.add('Existing Students Status missing',
+                    is_missing(report.iloc[:, 6]), students,
+                    'Status is missing for student with the Student ID {}')
+    tags = report.iloc[:, 7]
+    diagnostics.add('Existing Students Tag missing', is_missing(tags),
+                    students, 'Tag is missing for student with the '
+                    'Student ID {}')
+    # Check that tag is correct
+    errors.add('Tag not valid',
+               ~tags.fillna('').str.lower().isin(VALID_TAGS), students,
+               'Tag for student with the Student ID {} is not valid.')
+    # A student has a row for each enrolment, so only the Enrolment Code
+    # should be unique
+    diagnostics.add('Existing Students Enrolment Code repeated',
+                    (enrolments != '') & enrolments.duplicated(), enrolments,
+                    'Enrolment Code {} appears more than once in the '
+                    'Existing Students')
     # Check if any errors have been identified, save error log if they have
-    if len(errors) > 0:
-        ft.process_error_log(errors, 'Existing Students Data File')
-    # Check if any warnings have been identified, save error log if they have
-    if len(warnings) > 1:
-        return True, warnings
-    else:
-        return False, warnings
+    if log_errors:
+        save_errors(errors, 'Existing Students Data File')
+    return diagnostics
 
 
-def check_insightly(report_data):
-    """Return list of warnings for information in Insightly data.
+def check_insightly(report_data, diagnostics=None, errors=None):
+    """Record issues with the information in Insightly data.
 
     Checks the Insightly data to see if the required information is present.
-    Missing or incorrect information that is non-fatal is appended to a
-    warnings list and returned.
+    Missing or incorrect information that is non-fatal is recorded as a
+    warning in diagnostics, which is returned.
+
+    Each check is applied to a whole column at once, and only the students
+    that fail it are recorded. Errors are summarised in the error log.
 
     Args:
-        report_data (list): Insightly report data.
+        report_data (list): Insightly report data, as a list of rows or a
+        DataFrame.
+        diagnostics (Diagnostics): (Optional) Collector to record warnings
+        in. If not provided, a new collector is created.
+        errors (Diagnostics): (Optional) Collector to record errors in. If
+        not provided, errors are saved to the error log straight away.
 
     Returns:
-        True if warnings list has had items appended to it, False otherwise.
-        warnings (list): Warnings that have been identified in the data.
+        diagnostics (Diagnostics): Warnings that have been identified in the
+        data.
 
     File structure (report_data):
         StudentID, First Name, Last Name, Tags.
@@ -90,29 +1356,30 @@ def check_insightly(report_data):
     File source (report_data):
         Insightly Data Dump (using columns listed in File structure).
     """
-    errors = []
-    i = 0
-    warnings = ['\nInsightly Data File Warnings:\n']
-    while i < len(report_data):
-        student = report_data[i]
-        if student[1] in (None, ''):
-            errors.append('First Name is missing for student with the '
-                          'Student ID {}'.format(student[0]))
-        if student[2] in (None, ''):
-            errors.append('Last Name is missing for student with the '
-                          'Student ID {}'.format(student[0]))
-        if student[3] in (None, ''):
-            warnings.append('Tags is missing for student with the '
-                          'Student ID {}'.format(student[0]))
-        i += 1
+    log_errors = errors is None
+    if log_errors:
+        errors = Diagnostics('Insightly Data File Errors')
+    if diagnostics is None:
+        diagnostics = Diagnostics('Insightly Data File Warnings')
+    report = to_report_frame(report_data, 4)
+    students = report.iloc[:, 0].fillna('')
+    errors.add('First Name missing', is_missing(report.iloc[:, 1]),
+               students, 'First Name is missing for student with the '
+               'Student ID {}')
+    errors.add('Last Name missing', is_missing(report.iloc[:, 2]),
+               students, 'Last Name is missing for student with the '
+               'Student ID {}')
+    diagnostics.add('Insightly Tags missing', is_missing(report.iloc[:, 3]),
+                    students, 'Tags is missing for student with the '
+                    'Student ID {}')
+    diagnostics.add('Insightly Student ID repeated',
+                    (students != '') & students.duplicated(), students,
+                    'Student ID {} appears more than once in the Insightly '
+                    'Data')
     # Check if any errors have been identified, save error log if they have
-    if len(errors) > 0:
-        ft.process_error_log(errors, 'Insightly Data File')
-    # Check if any warnings have been identified, save error log if they have
-    if len(warnings) > 1:
-        return True, warnings
-    else:
-        return False, warnings
+    if log_errors:
+        save_errors(errors, 'Insightly Data File')
+    return diagnostics
 
 
 def check_repeat():
@@ -151,148 +1418,254 @@ def check_review_warnings():
             return False
 
 
-def clean_exist_stud(raw_data):
-    """Clean data in the Existing students data.
-    
-    Extracts the desired columns from the Existing student data and cleans the
-    raw data.
-    
+def classify_shard(tags, courses, tutors, match=DEFAULT_TAG_MATCH):
+    """Return the Course, Status, Tutor and Inactive columns for a shard.
+
+    Run in a worker process, where the matcher is compiled once and cached.
+
     Args:
-        raw_data (list): Raw existing student data.
-        
-    Returns:
-        cleaned_data (list): Existing student data that has been cleaned.
-    
-    File structure (raw_data):
-        EnrolmentPK, StudentID, CourseFK, TutorFK, StartDate, ExpiryDate,
-        Status, Tag.
+        tags (Series): Contact tag data for each student in the shard.
+        courses (tuple): Course codes in order of priority.
+        tutors (tuple): Tutor names in order of priority.
+        match (str): 'token' to match keywords to whole tags, or
+        'substring' to find them anywhere in the Tags.
 
-    File source (raw_data):
-        Enrolments Table in Student Database.
+    Returns:
+        found (DataFrame): Course, Status, Tutor and Inactive columns,
+        aligned with the index of tags.
     """
-    cleaned_data = []
-    i = 0
-    while i < len(raw_data):
-        student = raw_data[i]
-        cleaned_student = []
-        # Extract and clean desired columns
-        cleaned_student.append(student[0].strip())
-        cleaned_student.append(student[1].strip())
-        cleaned_student.append(student[7].strip())
-        cleaned_data.append(cleaned_student)
-        i += 1
-    return cleaned_data        
+    return get_tag_matcher(courses, tutors, match).classify_series(tags)
 
 
-def clean_insightly(raw_data):
-    """Clean data in the Insightly data.
-    
-    Extracts the desired columns from the Insightly data and cleans the raw
-    data.
-    
+def classify_tags(tags, matcher, workers=1, shard_size=SHARD_SIZE):
+    """Return the Course, Status, Tutor and Inactive columns for Tags.
+
+    With more than one worker, the Tags are split into shards of shard_size
+    students that are classified in a pool of worker processes. The shards
+    are combined in their original order, so the results are identical to
+    classifying the Tags in this process.
+
     Args:
-        raw_data (list): Raw insightly data.
-        
+        tags (Series): Contact tag data for each student.
+        matcher (TagMatcher): Matcher for the courses and tutors.
+        workers (int): Number of worker processes to use.
+        shard_size (int): Number of students in each shard.
+
     Returns:
-        cleaned_data (list): Insightly data that has been cleaned.
-    
-    File structure (report_data):
-        StudentID, First Name, Last Name, Tags.
+        found (DataFrame): Course, Status, Tutor and Inactive columns,
+        aligned with the index of tags.
+    """
+    if workers <= 1 or len(tags) <= shard_size:
+        return matcher.classify_series(tags)
+    shards = [tags.iloc[i:i + shard_size]
+              for i in range(0, len(tags), shard_size)]
+    courses = tuple(matcher.values['Course'])
+    tutors = tuple(matcher.values['Tutor'])
+    pool = get_process_pool(workers)
+    found = pool.map(classify_shard, shards, [courses] * len(shards),
+                     [tutors] * len(shards), [matcher.match] * len(shards))
+    return pd.concat(found)
 
-    File source (report_data):
-        Insightly Data Dump (using columns listed in File structure).
+
+def evict_cache(cache_dir, max_bytes=CACHE_MAX_BYTES):
+    """Remove the least recently used cache entries over the size limit.
+
+    Entries have their modification time updated whenever they are used, so
+    the oldest entries are the least recently used. Entries that another
+    process has already removed are skipped.
+
+    Args:
+        cache_dir (str): Folder used to cache the cleaned input data.
+        max_bytes (int): Largest total size of the cache entries.
     """
-    cleaned_data = []
-    i = 0
-    while i < len(raw_data):
-        student = raw_data[i]
-        cleaned_student = []
-        # Extract and clean desired columns
-        cleaned_student.append(student[0].strip())
-        cleaned_student.append(student[1].strip())
-        cleaned_student.append(student[2].strip())
-        cleaned_student.append(student[3].strip())
-        cleaned_data.append(cleaned_student)
-        i += 1
-    return cleaned_data
+    with CACHE_LOCK:
+        entries = []
+        for name in os.listdir(cache_dir):
+            if name.endswith('.pkl'):
+                path = os.path.join(cache_dir, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+        total = sum(entry[1] for entry in entries)
+        for mtime, size, path in sorted(entries):
+            if total <= max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+
+def finish_import(*modules):
+    """Finish importing lazily imported modules.
+
+    Lazy imports are not thread safe, so modules used by several threads
+    are imported before the threads start.
 
+    Args:
+        modules: Modules returned by lazy_import.
+    """
+    for module in modules:
+        # Using any attribute of a lazily imported module imports it
+        module.__dict__
+
+
+def format_optional(value, template='{}'):
+    """Return a value formatted for a table, or '' if it is None.
 
-def extract_course_tag(raw_data, courses):
-    """Replace Contact tag with Course tag.
-    
-    Replaces the Tags field with the student's Course tag, extracted
-    from the Tags list.
-    
     Args:
-        raw_data (str): String containing Contact tag data.
-        courses (list): List of course codes to check for.
-        
+        value: Value to be formatted.
+        template (str): Format string for the value.
+
     Returns:
-        The course code tag if found, 'N/A' otherwise.
+        text (str): The formatted value.
     """
-    for course in courses:
-        if re.search(course.lower(), raw_data.lower()):
-            return course
-    # No valid course found
-    return 'N/A'
+    if value is None:
+        return ''
+    return template.format(value)
 
 
-def extract_status_tag(raw_data):
-    """Replace Contact tag with Status tag.
-    
-    Replaces the Tags field with the colour tag for their status, extracted
-    from the Tags list.
-    
+def get_active_mask(found, sample, stats=None):
+    """Return which students to keep for a sample.
+
     Args:
-        raw_data (str): String containing Contact tag data.
-        
+        found (DataFrame): Extracted tags, including the Inactive column.
+        sample (str): 'All' or 'Active' students.
+        stats (RunStats): (Optional) Record of the time and memory used by
+        each stage.
+
     Returns:
-        The colour of their status tag if found, 'N/A' otherwise.
-    """
-    if re.search('suspended', raw_data.lower()):
-        return 'Suspended'
-    elif re.search('withdrawn', raw_data.lower()):
-        return 'Withdrawn'
-    elif re.search('graduated', raw_data.lower()):
-        return 'Graduated'
-    elif re.search('expired', raw_data.lower()):
-        return 'Expired'
-    elif re.search('on hold', raw_data.lower()):
-        return 'On Hold'
-    elif re.search('cancelled', raw_data.lower()):
-        return 'Cancelled'
-    elif re.search('green', raw_data.lower()):
-        return 'Green'
-    elif re.search('orange', raw_data.lower()):
-        return 'Orange'
-    elif re.search('red', raw_data.lower()):
-        return 'Red'
-    elif re.search('black', raw_data.lower()):
-        return 'Black'
-    elif re.search('purple', raw_data.lower()):
-        return 'Purple'
-    else:
-        return 'N/A'
+        active (ndarray): True for each student that is not Expired,
+        Graduated, Withdrawn or Transferred, or None to keep every student.
+    """
+    if sample != 'Active':
+        return None
+    if stats is None:
+        stats = RunStats()
+    with stats.stage('filter_inactive', len(found)) as record:
+        active = ~found['Inactive'].to_numpy(dtype=bool)
+        record['rows_out'] = int(active.sum())
+    return active
 
 
-def extract_tutor_tag(raw_data, tutors):
-    """Replace Contact tag with Tutor tag.
-    
-    Replaces the Tags field with the student's Tutor tag, extracted
-    from the Tags list.
-    
+def get_dump_date(f_name):
+    """Return the date of an Insightly Data dump.
+
+    The date is taken from the file name if it contains a valid date, as
+    in Insightly_Data_2018-09-25.csv or Insightly_Data_20180925.csv, and
+    from the time the file was last modified otherwise.
+
     Args:
-        raw_data (str): String containing Contact tag data.
-        tutors (list): List of tutor names to check for.
-        
+        f_name (str): Name of the Insightly Data file.
+
+    Returns:
+        dump_date (str): Date of the dump as YYYY-MM-DD.
+    """
+    found = re.search(r'(20\d\d)-?([01]\d)-?([0-3]\d)',
+                      os.path.basename(f_name))
+    if found is not None:
+        dump_date = '-'.join(found.groups())
+        try:
+            time.strptime(dump_date, '%Y-%m-%d')
+        except ValueError:
+            pass
+        else:
+            return dump_date
+    return time.strftime('%Y-%m-%d',
+                         time.localtime(os.path.getmtime(f_name)))
+
+
+def get_file_hash(f_name, cache_dir=None):
+    """Return the SHA-256 hash of the contents of a file.
+
+    If a cache folder is provided, hashes are stored in its index keyed by
+    the file path, size and modification time, so an unchanged file is only
+    read once. The index is updated while holding CACHE_LOCK, and replaced
+    as a whole, so it is never read half written.
+
+    Args:
+        f_name (str): Name of the file to be hashed.
+        cache_dir (str): (Optional) Folder used to cache the cleaned input
+        data.
+
+    Returns:
+        file_hash (str): Hex digest of the contents of the file.
+    """
+    stat = os.stat(f_name)
+    key = '{}|{}|{}'.format(os.path.abspath(f_name), stat.st_size,
+                            stat.st_mtime_ns)
+    if cache_dir is not None:
+        index_f_name = os.path.join(cache_dir, 'index.json')
+        with CACHE_LOCK:
+            index = load_cache_index(index_f_name)
+        if key in index:
+            return index[key]
+    digest = hashlib.sha256()
+    with open(f_name, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    file_hash = digest.hexdigest()
+    if cache_dir is not None:
+        # Only the latest version of each file is kept in the index. The
+        # index is read again, as other files may have been added to it
+        path = key.rsplit('|', 2)[0]
+        with CACHE_LOCK:
+            index = load_cache_index(index_f_name)
+            index = {k: v for k, v in index.items()
+                     if k.rsplit('|', 2)[0] != path}
+            index[key] = file_hash
+            temp_f_name = get_temp_name(index_f_name)
+            with open(temp_f_name, 'w') as f:
+                json.dump(index, f)
+            os.replace(temp_f_name, index_f_name)
+    return file_hash
+
+
+def get_file_name(source):
+    """Return user input for the name of a file to be read from disk.
+
+    Args:
+        source (str): The code for the table that the file belongs to.
+
+    Returns:
+        f_name (str): Name of an existing file.
+    """
+    f_name = ''
+    while f_name == '':
+        f_name = input('\nEnter the file name for the {} file (including '
+                       'the .csv extension) --> '.format(source))
+        if not os.path.isfile(f_name):
+            print('\nThat file could not be found! Please try again.')
+            f_name = ''
+    return f_name
+
+
+def get_match():
+    """Return user input for how keywords are matched to the tags.
+
     Returns:
-        The name of their tutor tag if found, 'N/A' otherwise.
+        match (str): 'token' or 'substring'.
     """
-    for tutor in tutors:
-        if re.search(tutor.lower(), raw_data.lower()):
-            return tutor
-    # No valid tutor found
-    return 'N/A'
+    repeat = True
+    high = 2
+    while repeat:
+        match_menu()
+        try:
+            action = int(input('\nPlease enter the number for your '
+                               'selection --> '))
+        except ValueError:
+            print('Please enter a number between 1 and {}.'.format(high))
+        else:
+            if action < 1 or action > high:
+                print('\nPlease select from the available options (1 - {})'
+                      .format(high))
+            elif action == 1:
+                return 'token'
+            elif action == 2:
+                return 'substring'
 
 
 def get_old_response():
@@ -315,6 +1688,122 @@ def get_old_response():
             return False
 
 
+def get_output_name(view, out_f_name='', out_format=''):
+    """Return the name of the file to save a table to.
+
+    Args:
+        view (str): Name of the table, used to generate a file name.
+        out_f_name (str): (Optional) Name of the file to save. If provided,
+        it is returned unchanged, unless it is only a folder ending with a
+        separator, when a generated name in that folder is returned.
+        out_format (str): (Optional) Format of the file to save. If not
+        provided, DEFAULT_OUTPUT_FORMAT is used.
+
+    Returns:
+        f_name (str): Name of the file to save.
+    """
+    folder, name = os.path.split(out_f_name or '')
+    if name != '':
+        return out_f_name
+    if out_format in (None, ''):
+        out_format = DEFAULT_OUTPUT_FORMAT
+    return os.path.join(folder, '{}_{}.{}'.format(
+            view, ft.generate_time_string(), out_format))
+
+
+def get_output_names(modes, out_f_name='', out_format=''):
+    """Return the names of the files to save the tables of extractions to.
+
+    A single table is named by get_output_name. For several tables, the
+    name of each table is added to the start of the file name, e.g.
+    'out/run.csv' saves out/Status_Tags_run.csv. If no file name is given,
+    or only a folder, a time stamped name is generated.
+
+    Args:
+        modes (list): Extractions whose tables are saved, from EXTRACTIONS.
+        out_f_name (str): (Optional) Name of the file to save.
+        out_format (str): (Optional) Format of the files to save. If not
+        provided, DEFAULT_OUTPUT_FORMAT is used for generated names.
+
+    Returns:
+        f_names (list): Name of the file to save each table to.
+    """
+    if len(modes) == 1:
+        return [get_output_name(EXTRACTIONS[modes[0]]['view'], out_f_name,
+                                out_format)]
+    folder, suffix = os.path.split(out_f_name or '')
+    if suffix == '':
+        suffix = '{}.{}'.format(ft.generate_time_string(),
+                                out_format or DEFAULT_OUTPUT_FORMAT)
+    return [os.path.join(folder, '{}_{}'.format(EXTRACTIONS[mode]['view'],
+                                                 suffix))
+            for mode in modes]
+
+
+def get_peak_rss():
+    """Return the peak resident memory of the process in MB.
+
+    Returns:
+        The peak resident set size in MB, or None where it is not available.
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Reported in bytes on macOS and kilobytes elsewhere
+    if sys.platform == 'darwin':
+        return peak / 1024 ** 2
+    return peak / 1024
+
+
+@functools.lru_cache(maxsize=None)
+def get_process_pool(workers):
+    """Return a pool of worker processes, creating it on first use.
+
+    Pools are kept for the life of the program, so later extractions do not
+    pay for starting the workers again.
+
+    Args:
+        workers (int): Number of worker processes.
+
+    Returns:
+        pool (ProcessPoolExecutor): Pool of worker processes.
+    """
+    return futures.ProcessPoolExecutor(max_workers=workers)
+
+
+def get_run_options(keep_old=None, sample=None, match=None):
+    """Return the students to be included in an extraction.
+
+    Args:
+        keep_old (bool): (Optional) True to include students that are not in
+        the Student Database. If not provided, user will be prompted.
+        sample (str): (Optional) 'All' or 'Active' students. If not provided
+        and keep_old is False, user will be prompted.
+        match (str): (Optional) 'token' to match keywords to whole tags, or
+        'substring' to find them anywhere in the Tags. If not provided, user
+        will be prompted.
+
+    Returns:
+        keep_old (bool): True to include students not in the Student Database.
+        sample (str): 'All' or 'Active'.
+        source (str): The code for the Existing Students data to be loaded.
+        match (str): 'token' or 'substring'.
+    """
+    # Ask if want all students or only those in the Student Database
+    if keep_old is None:
+        keep_old = get_old_response()
+    # Get sample to use - if do not want old students
+    if keep_old:
+        sample = 'All'
+    elif sample in (None, ''):
+        sample = get_sample()
+    source = '{} Students Data'.format(sample)
+    # Ask how to match keywords, as whole tags are now matched by default
+    if match in (None, ''):
+        match = get_match()
+    return keep_old, sample, source, match
+
+
 def get_sample():
     """Return user input for source of data.
     
@@ -340,45 +1829,546 @@ def get_sample():
                 return 'Active'
 
 
-def load_data(source, f_name=''):
-    """Read data from a file.
+def get_status_counts(history_f_name=HISTORY_STORE, start='', end=''):
+    """Return the number of students with each Status in each dump.
+
+    The counts are stored when each dump is added to the Status History,
+    so the history itself is not read.
+
+    Args:
+        history_f_name (str): SQLite database holding the Status History.
+        start (str): (Optional) First dump date to include, as YYYY-MM-DD.
+        end (str): (Optional) Last dump date to include, as YYYY-MM-DD.
+
+    Returns:
+        counts (DataFrame): DumpDate and a column of counts for each Status,
+        in date order.
+    """
+    connection = open_history_store(history_f_name)
+    try:
+        counts = pd.read_sql_query(
+                'SELECT dumps.DumpDate, status_counts.Status, '
+                'status_counts.Students FROM status_counts JOIN dumps ON '
+                'dumps.DumpID = status_counts.DumpID WHERE dumps.DumpDate '
+                'BETWEEN ? AND ?', connection,
+                params=(start or '0000-00-00', end or '9999-99-99'))
+    finally:
+        connection.close()
+    counts = counts.pivot(index='DumpDate', columns='Status',
+                          values='Students').fillna(0).astype(int)
+    # Statuses in order of priority, as in the extracted files
+    order = [value for _, value in STATUS_TAGS] + ['N/A']
+    counts = counts[[status for status in order if status in counts]]
+    counts.columns.name = None
+    return counts.sort_index().reset_index()
+
+
+def get_status_timeline(student_id, history_f_name=HISTORY_STORE,
+        changes_only=True):
+    """Return the tags of a student in each dump in the Status History.
+
+    Args:
+        student_id (str): StudentID of the student.
+        history_f_name (str): SQLite database holding the Status History.
+        changes_only (bool): True to only include the first dump the student
+        is in and the dumps where their Status changed.
+
+    Returns:
+        timeline (DataFrame): DumpDate, Course, Tutor, Status and Inactive
+        for the student in each dump, in date order.
+    """
+    connection = open_history_store(history_f_name)
+    try:
+        timeline = pd.read_sql_query(
+                'SELECT dumps.DumpDate, course.Value AS Course, '
+                'tutor.Value AS Tutor, status.Value AS Status, '
+                'history.Inactive FROM history '
+                'JOIN dumps ON dumps.DumpID = history.DumpID '
+                'JOIN tag_values AS course ON course.Code = history.Course '
+                'JOIN tag_values AS tutor ON tutor.Code = history.Tutor '
+                'JOIN tag_values AS status ON status.Code = history.Status '
+                'WHERE history.StudentID = ? ORDER BY dumps.DumpDate',
+                connection,
+                params=(str(student_id).strip(),))
+    finally:
+        connection.close()
+    timeline['Inactive'] = timeline['Inactive'].astype(bool)
+    if changes_only:
+        timeline = timeline[timeline['Status'] != timeline['Status'].shift()]
+    return timeline.reset_index(drop=True)
+
+
+def get_student_keys(frame):
+    """Return the StudentIDs of a table as integers, if they are numbers.
+
+    StudentIDs are only converted if every one of them is a plain number
+    without leading zeros, signs or spaces, so that two StudentIDs are
+    equal as integers exactly when they are equal as strings.
+
+    Args:
+        frame (DataFrame): Table with a StudentID column, and optionally
+        the StudentKey column added when the data was loaded.
+
+    Returns:
+        keys (ndarray): The StudentIDs as integers, or None if they cannot
+        all be converted.
+    """
+    if 'StudentKey' in frame:
+        return frame['StudentKey'].to_numpy()
+    ids = frame['StudentID']
+    try:
+        keys = ids.to_numpy(dtype=object).astype(np.int64)
+    except (ValueError, TypeError, OverflowError):
+        return None
+    # Number of digits in each key, to compare with the StudentID lengths
+    digits = np.searchsorted(10 ** np.arange(19, dtype=np.int64),
+                             np.maximum(keys, 1), side='right')
+    if not np.array_equal(digits, ids.str.len().to_numpy()):
+        return None
+    return keys
+
+
+def get_tag_keys(column):
+    """Return the lowercased value of each tag in a column.
+
+    The values are lowercased once for each category rather than for each
+    student, so tags can be compared whatever their case.
+
+    Args:
+        column (Series): Tag values for each student.
+
+    Returns:
+        keys (ndarray): Lowercased tag for each student, with '' for a
+        missing tag.
+    """
+    column = column.astype('category')
+    # The code of a missing tag is -1, which takes the last key
+    keys = np.array([str(value).strip().lower() for value in
+                     column.cat.categories] + [''], dtype=object)
+    return keys[column.cat.codes.to_numpy()]
+
+
+@functools.lru_cache(maxsize=32)
+def get_tag_matcher(courses=(), tutors=(), match=DEFAULT_TAG_MATCH):
+    """Return a compiled TagMatcher for the courses and tutors.
+
+    Matchers are cached so that the pattern is only compiled once for each
+    combination of courses, tutors and way of matching.
+
+    Args:
+        courses (tuple): Course codes in order of priority.
+        tutors (tuple): Tutor names in order of priority.
+        match (str): 'token' to match keywords to whole tags, or
+        'substring' to find them anywhere in the Tags.
+
+    Returns:
+        matcher (TagMatcher): Matcher for the courses and tutors.
+    """
+    return TagMatcher(courses, tutors, match)
+
+
+def get_temp_name(f_name):
+    """Return a name to save a file under before it replaces f_name.
+
+    The name is unique to the process and thread, and in the same folder
+    as f_name, so the file can be moved over f_name with os.replace.
+
+    Args:
+        f_name (str): Name of the file to be replaced.
+
+    Returns:
+        temp_f_name (str): Name of the temporary file.
+    """
+    return '{}.{}-{}.tmp'.format(f_name, os.getpid(), threading.get_ident())
+
+
+def get_view_tags(tags, mode):
+    """Return the columns of the extracted tags saved by an extraction.
+
+    The columns are not copied. A single extracted tag is saved in the
+    Tags column, as in earlier versions.
+
+    Args:
+        tags (DataFrame): Enrolment Code, StudentID, First Name, Last Name
+        and the extracted tags for each student.
+        mode (str): The extraction whose table is saved, from EXTRACTIONS.
+
+    Returns:
+        view_tags (DataFrame): The columns saved by the extraction.
+    """
+    headings = ['Enrolment Code', 'StudentID', 'First Name', 'Last Name']
+    columns = EXTRACTIONS[mode]['columns']
+    if len(columns) == 1:
+        names = headings + ['Tags']
+    else:
+        names = headings + columns
+    return pd.DataFrame({name: tags[heading] for name, heading in
+                         zip(names, headings + columns)}, copy=False)
+
+
+def is_missing(column):
+    """Return True for each value in a column that is missing or blank.
+
+    Args:
+        column (Series): Values to be checked.
+
+    Returns:
+        missing (Series): True where the value is None, NaN or ''.
+    """
+    return column.isna() | (column == '')
+
+
+def join_students(exist, insight, keep_old, headings=None, mask=None):
+    """Return the extracted Insightly data joined to the Existing Students.
+
+    Students are in the order of the Insightly data if keep_old is True,
+    and in the order of the Existing Students otherwise.
+
+    Args:
+        exist (DataFrame): Enrolment Code, StudentID and Tag for each
+        student in the Student Database.
+        insight (DataFrame): Insightly data with the extracted tag columns.
+        keep_old (bool): True to include students that are not in the
+        Student Database.
+        headings (list): (Optional) Columns to return. Defaults to the
+        All_Tags columns.
+        mask (ndarray): (Optional) True for each Insightly student to
+        include. Defaults to every student.
+
+    Returns:
+        tags (DataFrame): The joined data.
+    """
+    if headings is None:
+        headings = ['Enrolment Code', 'StudentID', 'First Name', 'Last Name',
+                    'Course', 'Tutor', 'Status']
+    return StudentIndex(exist).join(insight, keep_old, headings, mask=mask)
+
+
+def load_cache_index(index_f_name):
+    """Return the file hashes stored in the cache index.
+
+    Args:
+        index_f_name (str): Name of the cache index file.
+
+    Returns:
+        index (dict): Hash of each file, keyed by the file path, size and
+        modification time, or an empty dict if there is no valid index.
+    """
+    try:
+        with open(index_f_name) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def load_cached(kind, f_name, loader, cache_dir=CACHE_DIR):
+    """Return the result of a loader, using the cache if possible.
+
+    Results are cached by the kind of data and the hash of the file
+    contents, so a file that has not changed is not parsed again. The
+    extraction service also keeps recent results in memory. Loaders return
+    the state of their error and warning collectors with the data, so the
+    problems found when the file was first loaded are reported again when
+    it is loaded from the cache.
+
+    Args:
+        kind (str): Name for the kind of data being loaded.
+        f_name (str): Name of the file being loaded.
+        loader (function): Function taking no arguments that loads the file.
+        cache_dir (str): Folder used to cache the cleaned input data, or
+        None to always call the loader.
+
+    Returns:
+        The result of the loader.
+    """
+    if cache_dir is None:
+        return loader()
+    os.makedirs(cache_dir, exist_ok=True)
+    key = '{}_{}_{}'.format(kind, CACHE_VERSION,
+                            get_file_hash(f_name, cache_dir))
+    result = MEMORY_CACHE.get(key)
+    if result is not None:
+        print('\nLoaded {} from memory.'.format(f_name))
+        return result
+    path = os.path.join(cache_dir, '{}.pkl'.format(key))
+    try:
+        with open(path, 'rb') as f:
+            result = pickle.load(f)
+    except (OSError, pickle.UnpicklingError, EOFError):
+        pass
+    else:
+        # Mark the entry as recently used, unless it has just been removed
+        with contextlib.suppress(FileNotFoundError):
+            os.utime(path)
+        print('\nLoaded {} from the cache.'.format(f_name))
+        MEMORY_CACHE.put(key, result)
+        return result
+    result = loader()
+    temp_f_name = get_temp_name(path)
+    with open(temp_f_name, 'wb') as f:
+        pickle.dump(result, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(temp_f_name, path)
+    evict_cache(cache_dir)
+    MEMORY_CACHE.put(key, result)
+    return result
+
+
+def load_exist_frame(source, f_name='', cache_dir=CACHE_DIR, errors=None):
+    """Return the checked and cleaned Existing Students data.
 
     Args:
-        source (str): The code for the table that the source data belongs to.
+        source (str): The code for the Existing Students data to be loaded.
         f_name (str): (Optional) File name to be loaded. If not provided, user
         will be prompted to provide a file name.
+        cache_dir (str): Folder used to cache the cleaned input data, or
+        None to always load the data from the file.
+        errors (list): (Optional) List to add the source and errors of the
+        file to. If not provided, errors are saved to the error log straight
+        away.
 
     Returns:
-        read_data (list): A list containing the data read from the file.
-        True if warnings list has had items appended to it, False otherwise.
-        warnings (list): Warnings that have been identified in the data.
+        exist (DataFrame): Enrolment Code, StudentID and Tag for each
+        student, with Tag as a Categorical.
+        diagnostics (Diagnostics): Warnings that have been identified in the
+        data.
     """
-    warnings = []
-    # Load file
-    if f_name in (None, ''): # Get from user
-        read_data = ft.get_csv_fname_load(source)
-    else:
-        read_data = ft.load_csv(f_name, 'e')
-    # Check that data has entries for each required column
-    if source in ['All Students Data', 'Active Students Data']:
-        to_add, items_to_add = check_existing_students(read_data)
-        if to_add:
-            for item in items_to_add:
-                warnings.append(item)
-    elif source == 'Insightly_Data_':
-        to_add, items_to_add = check_insightly(read_data)
-        if to_add:
-            for item in items_to_add:
-                warnings.append(item)
-    if len(warnings) > 0:
-        return read_data, True, warnings
-    else:
-        return read_data, False, warnings
+    if f_name in (None, ''):
+        f_name = get_file_name(source)
+
+    def loader():
+        # Only EnrolmentPK, StudentID, Status and Tag are read from the file
+        report = read_csv_columns(f_name, [0, 1, 6, 7])
+        errors = Diagnostics('Existing Students Data File Errors')
+        diagnostics = check_existing_students(report.reindex(
+                columns=range(8)), errors=errors)
+        # Clean the Existing Student data and extract desired columns
+        exist = strip_columns(report[[0, 1, 7]])
+        exist.columns = ['Enrolment Code', 'StudentID', 'Tag']
+        add_student_keys(exist)
+        # Only a few different tags are used, so store them as categories
+        exist['Tag'] = exist['Tag'].astype('category')
+        return exist, vars(diagnostics), vars(errors)
+
+    exist, state, found = load_cached('exist', f_name, loader, cache_dir)
+    add_errors(Diagnostics.from_state(found), 'Existing Students Data File',
+               errors)
+    return exist, Diagnostics.from_state(state)
+
+
+def load_inputs(source, exist_f_name='', insightly_f_name='',
+        courses_f_name='', tutors_f_name='', cache_dir=CACHE_DIR,
+        stats=None, diagnostics=None, errors=None):
+    """Return the input data for an extraction, loading the files at once.
+
+    Each file is read in its own thread, so the time spent waiting for one
+    file overlaps with reading the others. The Existing Students and
+    Insightly data are checked as soon as each file has been read. Any
+    file names that are needed are asked for first.
+
+    Args:
+        source (str): The code for the Existing Students data to be loaded.
+        exist_f_name (str): (Optional) Existing Students file name. If not
+        provided, user will be prompted.
+        insightly_f_name (str): (Optional) Insightly Data file name. If not
+        provided, user will be prompted.
+        courses_f_name (str): (Optional) Name of the course codes file, or
+        '' if the courses are not needed.
+        tutors_f_name (str): (Optional) Name of the tutor names file, or ''
+        if the tutors are not needed.
+        cache_dir (str): Folder used to cache the cleaned input data, or
+        None to always load the data from the files.
+        stats (RunStats): (Optional) Record of the time and memory used by
+        each stage.
+        diagnostics (Diagnostics): (Optional) Collector to add the warnings
+        identified in the data to.
+        errors (list): (Optional) List to add the source and errors of each
+        file to. If not provided, errors are saved to the error log straight
+        away.
+
+    Returns:
+        exist (DataFrame): Enrolment Code, StudentID and Tag for each
+        student.
+        insight (DataFrame): StudentID, First Name, Last Name and Tags for
+        each student.
+        courses (list): Course codes, or None if not loaded.
+        tutors (list): Tutor names, or None if not loaded.
+    """
+    if stats is None:
+        stats = RunStats()
+    if diagnostics is None:
+        diagnostics = Diagnostics()
+    # Files are chosen before loading starts, as only one prompt can be
+    # shown at a time
+    if exist_f_name in (None, ''):
+        exist_f_name = get_file_name(source)
+    if insightly_f_name in (None, ''):
+        insightly_f_name = get_file_name('Insightly_Data_')
+
+    finish_import(ad, ft, np, pd)
+
+    def load(stage, loader, *args):
+        with stats.stage(stage) as record:
+            result = loader(*args)
+            record['rows_out'] = len(result[0])
+        return result
+
+    with futures.ThreadPoolExecutor(max_workers=4) as pool:
+        exist_job = pool.submit(load, 'load_existing', load_exist_frame,
+                                source, exist_f_name, cache_dir, errors)
+        insight_job = pool.submit(load, 'load_insightly',
+                                  load_insightly_frame, insightly_f_name,
+                                  cache_dir, errors)
+        courses_job = tutors_job = None
+        if courses_f_name not in (None, ''):
+            courses_job = pool.submit(ft.load_headings, courses_f_name)
+        if tutors_f_name not in (None, ''):
+            tutors_job = pool.submit(ft.load_headings, tutors_f_name)
+        exist, exist_diagnostics = exist_job.result()
+        insight, insight_diagnostics = insight_job.result()
+        courses = None if courses_job is None else courses_job.result()
+        tutors = None if tutors_job is None else tutors_job.result()
+    diagnostics.update(exist_diagnostics)
+    diagnostics.update(insight_diagnostics)
+    return exist, insight, courses, tutors
+
+
+def load_insightly_frame(f_name='', cache_dir=CACHE_DIR, errors=None):
+    """Return the checked and cleaned Insightly data.
+
+    Args:
+        f_name (str): (Optional) File name to be loaded. If not provided, user
+        will be prompted to provide a file name.
+        cache_dir (str): Folder used to cache the cleaned input data, or
+        None to always load the data from the file.
+        errors (list): (Optional) List to add the source and errors of the
+        file to. If not provided, errors are saved to the error log straight
+        away.
+
+    Returns:
+        insight (DataFrame): StudentID, First Name, Last Name and Tags for
+        each student.
+        diagnostics (Diagnostics): Warnings that have been identified in the
+        data.
+    """
+    if f_name in (None, ''):
+        f_name = get_file_name('Insightly_Data_')
+
+    def loader():
+        report = read_csv_columns(f_name, [0, 1, 2, 3])
+        errors = Diagnostics('Insightly Data File Errors')
+        diagnostics = check_insightly(report, errors=errors)
+        # Clean the Insightly data and extract desired columns
+        insight = strip_columns(report)
+        insight.columns = ['StudentID', 'First Name', 'Last Name', 'Tags']
+        add_student_keys(insight)
+        return insight, vars(diagnostics), vars(errors)
+
+    insight, state, found = load_cached('insightly', f_name, loader,
+                                        cache_dir)
+    add_errors(Diagnostics.from_state(found), 'Insightly Data File', errors)
+    return insight, Diagnostics.from_state(state)
+
+
+def load_stream_inputs(source, exist_f_name='', insightly_f_name='',
+        courses_f_name='', tutors_f_name='', chunk_size=STREAM_CHUNK_SIZE,
+        stats=None, diagnostics=None, errors=None):
+    """Return the input data for an extraction, streaming the files.
+
+    Used for files too large for memory. The Existing Students file is
+    read, checked and cleaned in chunks of chunk_size rows, keeping only
+    the Enrolment Code and StudentID. The Insightly data is returned as an
+    iterator that reads, checks and cleans a chunk at a time, so only one
+    chunk is held in memory. Errors in each file are saved, or added to
+    errors, once the whole file has been checked.
+
+    Args:
+        source (str): The code for the Existing Students data to be loaded.
+        exist_f_name (str): (Optional) Existing Students file name. If not
+        provided, user will be prompted.
+        insightly_f_name (str): (Optional) Insightly Data file name. If not
+        provided, user will be prompted.
+        courses_f_name (str): (Optional) Name of the course codes file, or
+        '' if the courses are not needed.
+        tutors_f_name (str): (Optional) Name of the tutor names file, or ''
+        if the tutors are not needed.
+        chunk_size (int): Number of rows to read at a time.
+        stats (RunStats): (Optional) Record of the time and memory used by
+        each stage.
+        diagnostics (Diagnostics): (Optional) Collector to add the warnings
+        identified in the data to.
+        errors (list): (Optional) List to add the source and errors of each
+        file to. If not provided, errors are saved to the error log straight
+        away.
+
+    Returns:
+        exist (DataFrame): Enrolment Code and StudentID for each student.
+        chunks (iterator): DataFrames of the StudentID, First Name, Last
+        Name and Tags of chunk_size students.
+        courses (list): Course codes, or None if not loaded.
+        tutors (list): Tutor names, or None if not loaded.
+    """
+    if stats is None:
+        stats = RunStats()
+    if diagnostics is None:
+        diagnostics = Diagnostics()
+    if exist_f_name in (None, ''):
+        exist_f_name = get_file_name(source)
+    if insightly_f_name in (None, ''):
+        insightly_f_name = get_file_name('Insightly_Data_')
+    finish_import(ad, ft, np, pd)
+    courses = tutors = None
+    if courses_f_name not in (None, ''):
+        courses = ft.load_headings(courses_f_name)
+    if tutors_f_name not in (None, ''):
+        tutors = ft.load_headings(tutors_f_name)
+    # Only the columns needed for the join are kept
+    found = Diagnostics('Existing Students Data File Errors')
+    exist_chunks = []
+    with stats.stage('load_existing') as record:
+        for chunk in read_csv_columns(exist_f_name, [0, 1, 6, 7],
+                                      chunk_size):
+            check_existing_students(chunk.reindex(columns=range(8)),
+                                    diagnostics, found)
+            chunk = strip_columns(chunk[[0, 1]])
+            chunk.columns = ['Enrolment Code', 'StudentID']
+            exist_chunks.append(chunk)
+        if exist_chunks:
+            exist = pd.concat(exist_chunks, ignore_index=True)
+        else:
+            exist = pd.DataFrame(columns=['Enrolment Code', 'StudentID'])
+        record['rows_out'] = len(exist)
+    del exist_chunks
+    add_errors(found, 'Existing Students Data File', errors)
+
+    def load_chunks():
+        found = Diagnostics('Insightly Data File Errors')
+        headings = ['StudentID', 'First Name', 'Last Name', 'Tags']
+        reader = read_csv_columns(insightly_f_name, [0, 1, 2, 3],
+                                  chunk_size)
+        loaded = 0
+        while True:
+            with stats.stage('load_insightly') as record:
+                chunk = next(reader, None)
+                if chunk is None and loaded == 0:
+                    # An empty file still gives the headings
+                    chunk = pd.DataFrame(columns=range(4), dtype=object)
+                if chunk is not None:
+                    check_insightly(chunk, diagnostics, found)
+                    insight = strip_columns(chunk)
+                    insight.columns = headings
+                    record['rows_out'] = len(insight)
+            if chunk is None:
+                break
+            loaded += 1
+            yield insight
+        add_errors(found, 'Insightly Data File', errors)
+
+    return exist, load_chunks(), courses, tutors
 
 
 def main():
     repeat = True
-    high = 5
+    high = 10
     while repeat is True:
         try_again = False
         main_message()
@@ -402,6 +2392,16 @@ def main():
             elif action == 4:
                 process_all_tags_extraction()
             elif action == 5:
+                process_streaming_extraction()
+            elif action == 6:
+                process_all_views_extraction()
+            elif action == 7:
+                process_incremental_extraction()
+            elif action == 8:
+                process_history_extraction()
+            elif action == 9:
+                process_reconcile_extraction()
+            elif action == 10:
                 print('\nIf you have generated any files, please find them '
                       'saved to disk. Goodbye.')
                 sys.exit()
@@ -420,7 +2420,20 @@ def main_message():
     print('2. Extract Tutor Tags')
     print('3. Extract Course Tags')
     print('4. Extract All Tags')
-    print('5. Exit')
+    print('5. Extract All Tags (Large Files)')
+    print('6. Extract Status, Tutor, Course and All Tags')
+    print('7. Extract All Tags (Changed Students Only)')
+    print('8. Add Insightly Data to the Status History')
+    print('9. Compare Student Database Tags with Insightly')
+    print('10. Exit')
+
+
+def match_menu():
+    """Display the tag matching menu options."""
+    print('\nHow should course, tutor and status keywords be matched to the '
+          'Contact tags?:\n')
+    print('1: Whole tags only, so Ann does not match Anna')
+    print('2: Anywhere in the tags, as in earlier versions')
 
 
 def old_menu():
@@ -430,11 +2443,281 @@ def old_menu():
     print('2: Active Students')
 
 
-def process_all_tags_extraction():
-    """Process all tags for extraction.
+def open_history_store(f_name=HISTORY_STORE):
+    """Return a connection to the Status History, creating it if needed.
+
+    Each dump in the history has a row in the dumps table, with the number
+    of students with each Status in the status_counts table. The tags
+    extracted for each student are in the history table, which is stored in
+    StudentID order so that the timeline of a student is read from one
+    place. The Course, Tutor and Status of each student are stored as codes
+    for the tag values in the tag_values table, to keep the history small.
+
+    Args:
+        f_name (str): SQLite database holding the Status History.
+
+    Returns:
+        connection (Connection): Connection to the database.
+    """
+    connection = sqlite3.connect(f_name)
+    connection.executescript(
+            'CREATE TABLE IF NOT EXISTS dumps (DumpID INTEGER PRIMARY KEY, '
+            'DumpDate TEXT UNIQUE, FileName TEXT, Students INTEGER);'
+            'CREATE TABLE IF NOT EXISTS status_counts (DumpID INTEGER, '
+            'Status TEXT, Students INTEGER, PRIMARY KEY (DumpID, Status));'
+            'CREATE TABLE IF NOT EXISTS tag_values (Code INTEGER PRIMARY '
+            'KEY, Value TEXT UNIQUE);'
+            'CREATE TABLE IF NOT EXISTS history (StudentID TEXT, '
+            'DumpID INTEGER, Course INTEGER, Tutor INTEGER, Status INTEGER, '
+            'Inactive INTEGER, PRIMARY KEY (StudentID, DumpID)) '
+            'WITHOUT ROWID;')
+    return connection
+
+
+def parse_args(argv):
+    """Return the parsed command line arguments for a headless run.
+
+    Args:
+        argv (list): Command line arguments, excluding the program name.
+
+    Returns:
+        args (Namespace): Parsed arguments.
+    """
+    parser = argparse.ArgumentParser(
+            description='Extract Status, Tutor and Course tags from an '
+            'Insightly Data dump without prompting.')
+    parser.add_argument('mode', nargs='?', choices=MODES,
+                        help='Tags to extract.')
+    parser.add_argument('--existing', default='',
+                        help='Existing Students csv file.')
+    parser.add_argument('--insightly', default='',
+                        help='Insightly Data csv file. For the history '
+                        'mode, a pattern such as "dumps/*.csv" adds every '
+                        'matching dump.')
+    parser.add_argument('--keep-old', action='store_true',
+                        help='Include students not in the Student Database.')
+    parser.add_argument('--sample', choices=('All', 'Active'), default='All',
+                        help='Students to include if not keeping old '
+                        'students.')
+    parser.add_argument('--output', default='',
+                        help='Name of the file to save.')
+    parser.add_argument('--format', default='', choices=('',) +
+                        OUTPUT_FORMATS, help='Format of the file to save. '
+                        'Taken from the --output extension if not given.')
+    parser.add_argument('--courses', default='courses.txt',
+                        help='Course codes file.')
+    parser.add_argument('--tutors', default='tutors.txt',
+                        help='Tutor names file.')
+    parser.add_argument('--cache-dir', default=CACHE_DIR,
+                        help='Folder used to cache the cleaned input data.')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='Always load the input data from the files.')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of worker processes used to extract '
+                        'the tags.')
+    parser.add_argument('--shard-size', type=int, default=SHARD_SIZE,
+                        help='Number of students extracted by each worker '
+                        'process at a time.')
+    parser.add_argument('--match', default=DEFAULT_TAG_MATCH,
+                        choices=TAG_MATCH_MODES,
+                        help='Match keywords to whole tags (token) or '
+                        'anywhere in the Tags (substring, as in earlier '
+                        'versions).')
+    parser.add_argument('--timings', action='store_true',
+                        help='Print the time and memory used by each stage '
+                        'and save them next to the output file.')
+    parser.add_argument('--profile', default='',
+                        help='Name of a stage to profile with cProfile and '
+                        'tracemalloc, e.g. extract. Implies --timings.')
+    parser.add_argument('--summaries', action='store_true',
+                        help='Also save counts of students by Status and '
+                        'Tutor, Status and Course, and Tutor workload (all '
+                        'and views modes only).')
+    parser.add_argument('--stream', action='store_true',
+                        help='Read the input files in chunks, for files too '
+                        'large for memory (status, tutor, course, all and '
+                        'views modes only). Streamed files are not cached.')
+    parser.add_argument('--store', default=TAG_STORE,
+                        help='Tag store used by the incremental mode.')
+    parser.add_argument('--history', default=HISTORY_STORE,
+                        help='Status History used by the history, timeline '
+                        'and counts modes.')
+    parser.add_argument('--dump-date', default='',
+                        help='Date of the dump added by the history mode, '
+                        'as YYYY-MM-DD. Taken from the file name if not '
+                        'given.')
+    parser.add_argument('--student', default='',
+                        help='StudentID for the timeline mode.')
+    parser.add_argument('--start', default='',
+                        help='First dump date for the counts mode.')
+    parser.add_argument('--end', default='',
+                        help='Last dump date for the counts mode.')
+    parser.add_argument('--manifest', default='',
+                        help='JSON file with a list of jobs to run, each '
+                        'using the option names above as keys.')
+    parser.add_argument('--serve', action='store_true',
+                        help='Run as a service accepting jobs over HTTP '
+                        'on localhost, with the other options as defaults '
+                        'for each job.')
+    parser.add_argument('--port', type=int, default=SERVICE_PORT,
+                        help='Port the service listens on.')
+    parser.add_argument('--output-dir', default='',
+                        help='Folder the service saves files in. Defaults '
+                        'to the current folder.')
+    parser.add_argument('--import-times', action='store_true',
+                        help='Report how long the program takes to start '
+                        'and to import each of its slower modules.')
+    args = parser.parse_args(argv)
+    if args.import_times:
+        return args
+    if args.manifest in (None, '') and not args.serve:
+        if args.mode is None:
+            parser.error('a mode or --manifest is required')
+        if args.mode == 'timeline':
+            if args.student in (None, ''):
+                parser.error('--student is required for a timeline')
+        elif args.mode == 'history':
+            if args.insightly in (None, ''):
+                parser.error('--insightly is required')
+        elif args.mode != 'counts':
+            if args.existing in (None, '') or args.insightly in (None, ''):
+                parser.error('--existing and --insightly are required')
+    if args.keep_old and args.sample == 'Active':
+        parser.error('--sample Active cannot be used with --keep-old')
+    return args
+
+
+def process_all_tags_extraction(keep_old=None, sample=None, exist_f_name='',
+        insightly_f_name='', out_f_name='', out_format='',
+        courses_f_name='courses.txt', tutors_f_name='tutors.txt',
+        cache_dir=CACHE_DIR, workers=1, shard_size=SHARD_SIZE,
+        match=None, timings=False, profile_stage='',
+        summaries=False, interactive=True):
+    """Process all tags extraction.
+    
+    Extracts the course, tutor and status tag for each student, with the
+    summary counts if wanted. See process_extraction for the arguments and
+    the files used.
+    
+    Returns:
+        f_name (str): Name of the file that was saved, or a list of the
+        names of the All_Tags and summary files if summaries were saved.
+    """
+    return process_extraction(
+            'all', keep_old, sample, exist_f_name, insightly_f_name,
+            out_f_name, out_format, courses_f_name, tutors_f_name, cache_dir,
+            workers, shard_size, match, timings, profile_stage,
+            summaries=summaries, interactive=interactive)
+
+
+def process_all_views_extraction(keep_old=None, sample=None, exist_f_name='',
+        insightly_f_name='', out_f_name='', out_format='',
+        courses_f_name='courses.txt', tutors_f_name='tutors.txt',
+        cache_dir=CACHE_DIR, workers=1, shard_size=SHARD_SIZE,
+        match=None, timings=False, profile_stage='',
+        interactive=True):
+    """Process status, tutor, course and all tags from a single extraction.
+    
+    Loads and extracts the data once, then saves the Status_Tags,
+    Tutor_Tags, Course_Tags and All_Tags files as projections of the same
+    tags. out_f_name is a suffix for the names of the files, e.g.
+    'out/run.csv' saves out/Status_Tags_run.csv. See process_extraction for
+    the other arguments and the files used.
+    
+    Returns:
+        f_names (list): Names of the files that were saved.
+    """
+    return process_extraction(
+            'views', keep_old, sample, exist_f_name, insightly_f_name,
+            out_f_name, out_format, courses_f_name, tutors_f_name, cache_dir,
+            workers, shard_size, match, timings, profile_stage,
+            interactive=interactive)
+
+
+def process_course_tag_extraction(keep_old=None, sample=None, exist_f_name='',
+        insightly_f_name='', out_f_name='', out_format='',
+        courses_f_name='courses.txt', tutors_f_name='tutors.txt',
+        cache_dir=CACHE_DIR, workers=1, shard_size=SHARD_SIZE,
+        match=None, timings=False, profile_stage='',
+        interactive=True):
+    """Process course tag extraction.
+    
+    Extracts the course tag for each student and saves it in the Tags
+    column. See process_extraction for the arguments and the files used.
     
-    Extracts the course, tutor and status tag for each student. Returns a
-    DataFrame with the extracted students.
+    Returns:
+        f_name (str): Name of the file that was saved.
+    """
+    return process_extraction(
+            'course', keep_old, sample, exist_f_name, insightly_f_name,
+            out_f_name, out_format, courses_f_name, tutors_f_name, cache_dir,
+            workers, shard_size, match, timings, profile_stage,
+            interactive=interactive)
+
+
+def process_extraction(mode, keep_old=None, sample=None, exist_f_name='',
+        insightly_f_name='', out_f_name='', out_format='',
+        courses_f_name='courses.txt', tutors_f_name='tutors.txt',
+        cache_dir=CACHE_DIR, workers=1, shard_size=SHARD_SIZE,
+        match=None, timings=False, profile_stage='',
+        summaries=False, stream=False, interactive=True):
+    """Process an extraction configured in EXTRACTIONS.
+    
+    Runs the stages of build_tag_chunks for the tags of the extraction and
+    saves the result. The table of each extraction in saves is projected
+    from the same extracted tags, so the views extraction loads and
+    extracts the data once for all four tables. If summaries are wanted,
+    the Status_by_Tutor, Status_by_Course and Tutor_Workload counts are
+    saved as well, with '_status_by_tutor', '_status_by_course' and
+    '_tutor_workload' added to the name of the All_Tags file.
+
+    When streaming, each chunk of students is saved as soon as it has been
+    joined, in the order of the Insightly data, and csv is saved unless
+    another format is given.
+    
+    Args:
+        mode (str): The extraction to run, one of 'status', 'tutor',
+        'course', 'all' or 'views'.
+        keep_old (bool): (Optional) True to include students that are not in
+        the Student Database. If not provided, user will be prompted.
+        sample (str): (Optional) 'All' or 'Active' students. If not provided
+        and keep_old is False, user will be prompted.
+        exist_f_name (str): (Optional) Existing Students file name. If not
+        provided, user will be prompted.
+        insightly_f_name (str): (Optional) Insightly Data file name. If not
+        provided, user will be prompted.
+        out_f_name (str): (Optional) Name of the file to save. If not
+        provided, a time stamped name is generated. When several tables
+        are saved, the name of each table is added to the start of the file
+        name (see get_output_names).
+        out_format (str): (Optional) Format of the file to save, one of
+        OUTPUT_FORMATS. If not provided, it is taken from the extension of
+        out_f_name, or DEFAULT_OUTPUT_FORMAT is used.
+        courses_f_name (str): Name of the course codes file.
+        tutors_f_name (str): Name of the tutor names file.
+        cache_dir (str): Folder used to cache the cleaned input data, or
+        None to always load the data from the files.
+        workers (int): Number of worker processes used to extract the tags.
+        shard_size (int): Number of students extracted by each worker
+        process at a time.
+        match (str): (Optional) 'token' to match keywords to whole tags, or
+        'substring' to find them anywhere in the Tags. If not provided, user
+        will be prompted.
+        timings (bool): True to print the time and memory used by each
+        stage and save them next to the output file.
+        profile_stage (str): (Optional) Name of a stage to profile with
+        cProfile and tracemalloc when timings are saved.
+        summaries (bool): True to also save the summary counts. Only
+        available for the all and views extractions, without streaming.
+        stream (bool): True to read the files in chunks of
+        STREAM_CHUNK_SIZE rows, for files too large for memory.
+        interactive (bool): False to skip the required files confirmation
+        and save warnings next to the output file instead of processing
+        them with the user.
+    
+    Returns:
+        f_name (str): Name of the file that was saved, or a list of the
+        names of the saved files if several tables or summaries were saved.
     
     File structure (Existing students):
         EnrolmentPK, StudentID, CourseFK, TutorFK, StartDate, ExpiryDate,
@@ -461,172 +2744,307 @@ def process_all_tags_extraction():
     File source (tutors.txt):
         Tutors in Insightly (check Contact Tags in Contacts).
     """
-    warnings = ['\nProcessing All Student Tags Extraction data Warnings:\n']
-    warnings_to_process = False
-    print('\nExtracting All Student Tags.')
+    extraction = EXTRACTIONS[mode]
+    columns = extraction['columns']
+    saves = extraction.get('saves', [mode])
+    if summaries and len(columns) < 3:
+        raise ValueError('Summaries are only saved with all tags')
+    if summaries and stream:
+        raise ValueError('Summaries are not saved when streaming')
+    diagnostics = Diagnostics('Processing {} Extraction data Warnings'
+                              .format(extraction['title']))
+    stats = RunStats(profile_stage)
+    errors = []
+    if stream:
+        print('\nExtracting {} from large files.'.format(extraction['title']))
+    else:
+        print('\nExtracting {}.'.format(extraction['title']))
     # Confirm the required files are in place
-    required_files = ['Existing Students', 'Insightly Data', 'Course Codes',
-                      'Tutor Tags']
-    ad.confirm_files('Extracting All Student Tags', required_files)
+    if interactive:
+        ad.confirm_files('Extracting {}'.format(extraction['title']),
+                         extraction['files'])
     # Ask if want all students or only those in the Student Database
-    keep_old = get_old_response()
-    # Get sample to use - if do not want old students
-    if keep_old:
-        source = 'All Students Data'
-        sample = 'All'
-    else:
-        sample = get_sample()
-        source = '{} Students Data'.format(sample)
-    print('\nYou will need to load the {} file.'.format(source))
-    # Get name for 'Existing Students' Report data file and then load
-    exist_stud_data, to_add, warnings_to_add = load_data(source)
-    if to_add:
-        warnings_to_process = True
-        for line in warnings_to_add:
-            warnings.append(line)
-    # Get name for 'Insightly_Data' Report data file and then load
-    insightly_data, to_add, warnings_to_add = load_data('Insightly_Data_')
-    if to_add:
-        warnings_to_process = True
-        for line in warnings_to_add:
-            warnings.append(line)
-    # Load Courses File
-    courses = ft.load_headings('courses.txt')
-    # Load Tutors File
-    tutors = ft.load_headings('tutors.txt')
-    # Clean the Existing Student data and extract desired columns
-    exist_stud_clean = clean_exist_stud(exist_stud_data)
-    # Clean the Insightly data and extract desired columns
-    insightly_clean = clean_insightly(insightly_data)
-    # Create DataFrame for Existing students
-    headings = ['Enrolment Code', 'StudentID', 'Tag']
-    exist = pd.DataFrame(data = exist_stud_clean, columns = headings)
-    # Create DataFrame for Insightly Data
-    headings = ['StudentID', 'First Name', 'Last Name', 'Tags']
-    insight = pd.DataFrame(data = insightly_clean, columns = headings)
-    # Remove Expired, Graduated and Withdrawn students if desired
-    if sample == 'Active':
-        insight['Tags'] = insight['Tags'].apply(remove_inactive)
-        insight = insight.drop(insight.index[insight['Tags'] == 
-                                             'Remove'])
-    # Find course tag and save to column
-    insight['Course'] = insight['Tags'].apply(extract_course_tag,
-           args=(courses,))
-    # Find status tag and save to column
-    insight['Status'] = insight['Tags'].apply(extract_status_tag)
-    # Find tutor tag and save to column
-    insight['Tutor'] = insight['Tags'].apply(extract_tutor_tag,
-           args=(tutors,))
-    # Remove Students not in the Student Database, if required
-    if keep_old: # Keep all students in Insightly records
-        tags = pd.merge(exist, insight, on='StudentID', how='right')
-        tags['Enrolment Code'] = tags['Enrolment Code'].fillna('N/A')
-    else: # Remove students not in the Student Database
-        tags = pd.merge(exist, insight, on='StudentID', how='inner')
-    headings = ['Enrolment Code', 'StudentID', 'First Name', 'Last Name',
-                'Course', 'Tutor', 'Status']
-    tags = tags[headings]
-    # Save Master file
-    f_name = 'All_Tags_{}.xls'.format(ft.generate_time_string())
-    tags.to_excel(f_name, index=False)
-    print('\nAll_Tags has been saved to {}'.format(f_name))
-    ft.process_warning_log(warnings, warnings_to_process)
-
-
-def process_course_tag_extraction():
-    """Process course tag extraction.
+    keep_old, sample, source, match = get_run_options(keep_old, sample,
+                                                      match)
+    if exist_f_name in (None, ''):
+        print('\nYou will need to load the {} file.'.format(source))
+    chunk_size = None
+    if stream:
+        # Streamed files are never held in memory, so are not cached
+        chunk_size = STREAM_CHUNK_SIZE
+        cache_dir = None
+        if out_format in (None, '') and os.path.basename(
+                out_f_name or '') == '':
+            out_format = 'csv'
+    start = time.perf_counter()
+    f_names = get_output_names(saves, out_f_name, out_format)
+    writers = []
+    if stream:
+        writers = [TableWriter(f_name, out_format) for f_name in f_names]
+    try:
+        for tags in build_tag_chunks(
+                columns, keep_old, sample, source, exist_f_name,
+                insightly_f_name, courses_f_name, tutors_f_name, cache_dir,
+                workers, shard_size, match, stats, diagnostics, chunk_size,
+                errors):
+            # Save the table of each extraction, projected from the tags
+            for i, saved in enumerate(saves):
+                view_tags = get_view_tags(tags, saved)
+                with stats.stage('write', len(view_tags)):
+                    if not stream:
+                        write_table(view_tags, f_names[i], out_format)
+                        continue
+                    # An empty chunk is written to save the headings
+                    for j in range(0, max(len(view_tags), 1),
+                                   WRITE_CHUNK_SIZE):
+                        writers[i].write(
+                                view_tags.iloc[j:j + WRITE_CHUNK_SIZE])
+    finally:
+        for writer in writers:
+            writer.close()
+    for saved, f_name in zip(saves, f_names):
+        print('\n{} has been saved to {}'.format(EXTRACTIONS[saved]['view'],
+                                                 f_name))
+    # Summaries, timings and warnings are saved next to the last table
+    f_name = f_names[-1]
+    if summaries:
+        with stats.stage('summarise', len(tags)) as record:
+            tables = build_summaries(tags)
+            record['rows_out'] = sum(len(table) for table in tables.values())
+        stem, extension = os.path.splitext(f_name)
+        for view, table in tables.items():
+            summary_f_name = '{}_{}{}'.format(stem, view.lower(), extension)
+            with stats.stage('write', len(table)):
+                write_table(table, summary_f_name, out_format)
+            print('\n{} has been saved to {}'.format(view, summary_f_name))
+            f_names.append(summary_f_name)
+    if len(saves) > 1:
+        # Each separate run would have repeated everything but the write
+        total_time = time.perf_counter() - start
+        extract_time = total_time - stats.stages['write']['wall_s']
+        print('\nCompleted in {:.2f} seconds, an estimated {:.2f} seconds '
+              'faster than running the {} extractions separately.'.format(
+                      total_time, extract_time * (len(saves) - 1),
+                      len(saves)))
+    stats.finish(f_name, timings)
+    save_input_errors(errors, f_name)
+    save_warnings(diagnostics, f_name, interactive)
+    if len(f_names) > 1:
+        return f_names
+    return f_name
+
+
+def process_history_extraction(insightly_f_names=None, dump_date='',
+        courses_f_name='courses.txt', tutors_f_name='tutors.txt',
+        cache_dir=CACHE_DIR, history_f_name=HISTORY_STORE, workers=1,
+        shard_size=SHARD_SIZE, match=None, timings=False,
+        profile_stage='', interactive=True):
+    """Process Insightly Data dumps into the Status History.
     
-    Extracts the course tag for each student. Returns a DataFrame with the
-    extracted students.
+    Extracts the course, tutor and status tag for each student in each dump
+    and adds them to the Status History with the date of the dump. Adding a
+    dump for a date that is already in the history replaces it. Timelines
+    and daily counts can then be found with get_status_timeline and
+    get_status_counts without loading the dumps again.
     
-    File structure (Existing students):
-        EnrolmentPK, StudentID, CourseFK, TutorFK, StartDate, ExpiryDate,
-        Status, Tag.
+    Args:
+        insightly_f_names (list): (Optional) Insightly Data file names. If
+        not provided, user will be prompted for one.
+        dump_date (str): (Optional) Date of the dump as YYYY-MM-DD, for a
+        single file. If not provided, it is taken from each file name or
+        the time the file was last modified.
+        courses_f_name (str): Name of the course codes file.
+        tutors_f_name (str): Name of the tutor names file.
+        cache_dir (str): Folder used to cache the cleaned input data, or
+        None to always load the data from the files.
+        history_f_name (str): SQLite database holding the Status History.
+        workers (int): Number of worker processes used to extract the tags.
+        shard_size (int): Number of students extracted by each worker
+        process at a time.
+        match (str): (Optional) 'token' to match keywords to whole tags, or
+        'substring' to find them anywhere in the Tags. If not provided, user
+        will be prompted.
+        timings (bool): True to print the time and memory used by each
+        stage and save them next to the history.
+        profile_stage (str): (Optional) Name of a stage to profile with
+        cProfile and tracemalloc when timings are saved.
+        interactive (bool): False to skip the required files confirmation
+        and save warnings next to the history instead of processing them
+        with the user.
+    
+    Returns:
+        f_name (str): Name of the Status History database.
         
     File structure (Insightly_Data):
         StudentID, First Name, Last Name, Tags.
         
     File structure (courses.txt):
        Code of each course separated by a comma (no spaces).
-        
-    File source (Existing students):
-        Enrolments Table in Student Database.
-        
+    
+    File structure (tutors.txt):
+        First name of each tutor separated by a comma (no spaces).
+    
     File source (Insightly_Data):
         Insightly Data Dump (using columns listed in File structure).
     
     File source (courses.txt):
         Course codes taken from Student Database.
+    
+    File source (tutors.txt):
+        Tutors in Insightly (check Contact Tags in Contacts).
     """
-    warnings = ['\nProcessing Student Course Tag Extraction data Warnings:\n']
-    warnings_to_process = False
-    print('\nExtracting Student Course Tags.')
+    diagnostics = Diagnostics('Processing Status History data Warnings')
+    stats = RunStats(profile_stage)
+    errors = []
+    print('\nAdding Insightly Data to the Status History.')
     # Confirm the required files are in place
-    required_files = ['Existing Students', 'Insightly Data', 'Course Codes']
-    ad.confirm_files('Extracting Student Course Tags', required_files)
-    # Ask if want all students or only those in the Student Database
-    keep_old = get_old_response()
-    # Get sample to use - if do not want old students
-    if keep_old:
-        source = 'All Students Data'
-        sample = 'All'
+    required_files = ['Insightly Data', 'Course Codes', 'Tutor Tags']
+    if interactive:
+        ad.confirm_files('Adding to the Status History', required_files)
+    if match in (None, ''):
+        match = get_match()
+    if not insightly_f_names:
+        insightly_f_names = [get_file_name('Insightly_Data_')]
+    if dump_date not in (None, ''):
+        if len(insightly_f_names) > 1:
+            raise ValueError('A dump date can only be given for one file')
+        # Raises a ValueError for an invalid date
+        time.strptime(dump_date, '%Y-%m-%d')
+    # Checked before loading, as a later dump would replace an earlier one
+    # with the same date
+    dump_dates = {}
+    for f_name in insightly_f_names:
+        date = dump_date or get_dump_date(f_name)
+        if date in dump_dates:
+            raise ValueError('{} and {} are both dumps for {}. Please put '
+                             'the date of each dump in its file name.'
+                             .format(dump_dates[date], f_name, date))
+        dump_dates[date] = f_name
+    courses = ft.load_headings(courses_f_name)
+    tutors = ft.load_headings(tutors_f_name)
+    matcher = get_tag_matcher(tuple(courses), tuple(tutors), match)
+    for date, f_name in dump_dates.items():
+        with stats.stage('load_insightly') as record:
+            insight, insight_diagnostics = load_insightly_frame(
+                    f_name, cache_dir, errors)
+            diagnostics.update(insight_diagnostics)
+            record['rows_out'] = len(insight)
+        with stats.stage('extract', len(insight)) as record:
+            found = classify_tags(insight['Tags'], matcher, workers,
+                                  shard_size)
+            record['rows_out'] = len(found)
+        with stats.stage('store', len(insight)) as record:
+            record['rows_out'] = update_history_store(
+                    insight, found, date, f_name, history_f_name)
+        print('\nAdded {} students from {} for {}.'.format(
+                record['rows_out'], f_name, date))
+    print('\nStatus History has been saved to {}'.format(history_f_name))
+    stats.finish(history_f_name, timings)
+    save_input_errors(errors, history_f_name)
+    save_warnings(diagnostics, history_f_name, interactive)
+    return history_f_name
+
+
+def process_history_query(query, student_id='', start='', end='',
+        history_f_name=HISTORY_STORE, out_f_name='', out_format=''):
+    """Process a query of the Status History.
+    
+    Saves either the timeline of a student, listing the dumps where their
+    Status changed, or the number of students with each Status in each
+    dump.
+    
+    Args:
+        query (str): 'timeline' or 'counts'.
+        student_id (str): StudentID of the student, for a timeline.
+        start (str): (Optional) First dump date for the counts, as
+        YYYY-MM-DD.
+        end (str): (Optional) Last dump date for the counts, as YYYY-MM-DD.
+        history_f_name (str): SQLite database holding the Status History.
+        out_f_name (str): (Optional) Name of the file to save. If not
+        provided, a time stamped name is generated.
+        out_format (str): (Optional) Format of the file to save, one of
+        OUTPUT_FORMATS. If not provided, it is taken from the extension of
+        out_f_name, or DEFAULT_OUTPUT_FORMAT is used.
+    
+    Returns:
+        f_name (str): Name of the file that was saved.
+    """
+    if not os.path.isfile(history_f_name):
+        raise ValueError('No Status History found at {}'.format(
+                history_f_name))
+    if query == 'timeline':
+        if student_id in (None, ''):
+            raise ValueError('No StudentID given for the timeline')
+        view = 'Status_Timeline'
+        table = get_status_timeline(student_id, history_f_name)
+        if table.empty:
+            print('\nStudent {} is not in the Status History.'.format(
+                    student_id))
+        else:
+            print('\n{}'.format(table.to_string(index=False)))
+    elif query == 'counts':
+        view = 'Status_Counts'
+        table = get_status_counts(history_f_name, start, end)
     else:
-        sample = get_sample()
-        source = '{} Students Data'.format(sample)
-    print('\nYou will need to load the {} file.'.format(source))
-    # Get name for 'Existing Students' Report data file and then load
-    exist_stud_data, to_add, warnings_to_add = load_data(source)
-    if to_add:
-        warnings_to_process = True
-        for line in warnings_to_add:
-            warnings.append(line)
-    # Get name for 'Insightly_Data' Report data file and then load
-    insightly_data, to_add, warnings_to_add = load_data('Insightly_Data_')
-    if to_add:
-        warnings_to_process = True
-        for line in warnings_to_add:
-            warnings.append(line)
-    # Load Courses File
-    courses = ft.load_headings('courses.txt')
-    # Clean the Existing Student data and extract desired columns
-    exist_stud_clean = clean_exist_stud(exist_stud_data)
-    # Clean the Insightly data and extract desired columns
-    insightly_clean = clean_insightly(insightly_data)
-    # Create DataFrame for Existing students
-    headings = ['Enrolment Code', 'StudentID', 'Tag']
-    exist = pd.DataFrame(data = exist_stud_clean, columns = headings)
-    # Create DataFrame for Insightly Data
-    headings = ['StudentID', 'First Name', 'Last Name', 'Tags']
-    insight = pd.DataFrame(data = insightly_clean, columns = headings)
-    # Remove Expired, Graduated and Withdrawn students if desired
-    if sample == 'Active':
-        insight['Tags'] = insight['Tags'].apply(remove_inactive)
-        insight = insight.drop(insight.index[insight['Tags'] == 
-                                             'Remove'])
-    # Find course tag and save to column
-    insight['Tags'] = insight['Tags'].apply(extract_course_tag,
-           args=(courses,))
-    # Remove Students not in the Student Database, if required
-    if keep_old: # Keep all students in Insightly records
-        tags = pd.merge(exist, insight, on='StudentID', how='right')
-        tags['Enrolment Code'] = tags['Enrolment Code'].fillna('N/A')
-    else: # Remove students not in the Student Database
-        tags = pd.merge(exist, insight, on='StudentID', how='inner')
-    headings = ['Enrolment Code', 'StudentID', 'First Name', 'Last Name',
-                'Tags']
-    tags = tags[headings]
-    # Save Master file
-    f_name = 'Course_Tags_{}.xls'.format(ft.generate_time_string())
-    tags.to_excel(f_name, index=False)
-    print('\nCourse_Tags has been saved to {}'.format(f_name))
-    ft.process_warning_log(warnings, warnings_to_process)
-
-
-def process_status_tag_extraction():
-    """Process status tag extraction.
+        raise ValueError('Unknown query {}'.format(query))
+    f_name = get_output_name(view, out_f_name, out_format)
+    write_table(table, f_name, out_format)
+    print('\n{} has been saved to {}'.format(view, f_name))
+    return f_name
+
+
+def process_incremental_extraction(keep_old=None, sample=None, exist_f_name='',
+        insightly_f_name='', out_f_name='', out_format='',
+        courses_f_name='courses.txt', tutors_f_name='tutors.txt',
+        cache_dir=CACHE_DIR, store_f_name=TAG_STORE, workers=1,
+        shard_size=SHARD_SIZE, match=None, timings=False,
+        profile_stage='', interactive=True):
+    """Process all tags for extraction, only extracting changed students.
+    
+    Extracts the course, tutor and status tag for each student in the same
+    way as process_all_tags_extraction, but reuses the tags extracted by the
+    previous incremental run for students whose Tags have not changed. As
+    well as the full All_Tags file, a Status_Changes file is saved listing
+    the students whose status differs from the previous run, including new
+    students and students no longer in the Insightly data.
     
-    Extracts the status tag for each student. Returns a DataFrame with the
-    extracted students.
+    Args:
+        keep_old (bool): (Optional) True to include students that are not in
+        the Student Database. If not provided, user will be prompted.
+        sample (str): (Optional) 'All' or 'Active' students. If not provided
+        and keep_old is False, user will be prompted.
+        exist_f_name (str): (Optional) Existing Students file name. If not
+        provided, user will be prompted.
+        insightly_f_name (str): (Optional) Insightly Data file name. If not
+        provided, user will be prompted.
+        out_f_name (str): (Optional) Name of the file to save. If not
+        provided, a time stamped name is generated. The status changes are
+        saved with '_changes' added to the name.
+        out_format (str): (Optional) Format of the file to save, one of
+        OUTPUT_FORMATS. If not provided, it is taken from the extension of
+        out_f_name, or DEFAULT_OUTPUT_FORMAT is used.
+        courses_f_name (str): Name of the course codes file.
+        tutors_f_name (str): Name of the tutor names file.
+        cache_dir (str): Folder used to cache the cleaned input data, or
+        None to always load the data from the files.
+        store_f_name (str): SQLite database holding the tags extracted by
+        the previous incremental run.
+        workers (int): Number of worker processes used to extract the tags.
+        shard_size (int): Number of students extracted by each worker
+        process at a time.
+        match (str): (Optional) 'token' to match keywords to whole tags, or
+        'substring' to find them anywhere in the Tags. If not provided, user
+        will be prompted.
+        timings (bool): True to print the time and memory used by each
+        stage and save them next to the output file.
+        profile_stage (str): (Optional) Name of a stage to profile with
+        cProfile and tracemalloc when timings are saved.
+        interactive (bool): False to skip the required files confirmation
+        and save warnings next to the output file instead of processing
+        them with the user.
+    
+    Returns:
+        f_names (list): Names of the All_Tags and Status_Changes files.
     
     File structure (Existing students):
         EnrolmentPK, StudentID, CourseFK, TutorFK, StartDate, ExpiryDate,
@@ -635,82 +3053,121 @@ def process_status_tag_extraction():
     File structure (Insightly_Data):
         StudentID, First Name, Last Name, Tags.
         
+    File structure (courses.txt):
+       Code of each course separated by a comma (no spaces).
+    
+    File structure (tutors.txt):
+        First name of each tutor separated by a comma (no spaces).
+        
     File source (Existing students):
         Enrolments Table in Student Database.
         
     File source (Insightly_Data):
         Insightly Data Dump (using columns listed in File structure).
+    
+    File source (courses.txt):
+        Course codes taken from Student Database.
+    
+    File source (tutors.txt):
+        Tutors in Insightly (check Contact Tags in Contacts).
     """
-    warnings = ['\nProcessing Student Status Tag Extraction data Warnings:\n']
-    warnings_to_process = False
-    print('\nExtracting Student Status Tags.')
+    diagnostics = Diagnostics('Processing Incremental Tags Extraction data '
+                              'Warnings')
+    stats = RunStats(profile_stage)
+    errors = []
+    print('\nExtracting All Student Tags for changed students.')
     # Confirm the required files are in place
-    required_files = ['Existing Students', 'Insightly_Data']
-    ad.confirm_files('Extracting Student Status Tags', required_files)
+    required_files = ['Existing Students', 'Insightly Data', 'Course Codes',
+                      'Tutor Tags']
+    if interactive:
+        ad.confirm_files('Extracting All Student Tags', required_files)
     # Ask if want all students or only those in the Student Database
-    keep_old = get_old_response()
-    # Get sample to use - if do not want old students
-    if keep_old:
-        source = 'All Students Data'
-        sample = 'All'
-    else:
-        sample = get_sample()
-        source = '{} Students Data'.format(sample)
-    print('\nYou will need to load the {} file.'.format(source))
-    # Get name for 'Existing Students' Report data file and then load
-    exist_stud_data, to_add, warnings_to_add = load_data(source)
-    if to_add:
-        warnings_to_process = True
-        for line in warnings_to_add:
-            warnings.append(line)
-    # debug_list(exist_stud_data)
-    # Get name for 'Insightly_Data' Report data file and then load
-    insightly_data, to_add, warnings_to_add = load_data('Insightly_Data_')
-    if to_add:
-        warnings_to_process = True
-        for line in warnings_to_add:
-            warnings.append(line)
-    # debug_list(insightly_data)
-    # Clean the Existing Student data and extract desired columns
-    exist_stud_clean = clean_exist_stud(exist_stud_data)
-    # debug_list(exist_stud_clean)
-    # Clean the Insightly data and extract desired columns
-    insightly_clean = clean_insightly(insightly_data)
-    # debug_list(insightly_clean)
-    # Create DataFrame for Existing students
-    headings = ['Enrolment Code', 'StudentID', 'Tag']
-    exist = pd.DataFrame(data = exist_stud_clean, columns = headings)
-    # Create DataFrame for Insightly Data
-    headings = ['StudentID', 'First Name', 'Last Name', 'Tags']
-    insight = pd.DataFrame(data = insightly_clean, columns = headings)
+    keep_old, sample, source, match = get_run_options(keep_old, sample,
+                                                      match)
+    if exist_f_name in (None, ''):
+        print('\nYou will need to load the {} file.'.format(source))
+    # Load, check and clean the Existing Students and Insightly data,
+    # courses and tutors at the same time
+    exist, insight, courses, tutors = load_inputs(
+            source, exist_f_name, insightly_f_name, courses_f_name,
+            tutors_f_name, cache_dir, stats, diagnostics, errors)
+    # Find tags for new and changed students, reusing the rest
+    matcher = get_tag_matcher(tuple(courses), tuple(tutors), match)
+    with stats.stage('extract', len(insight)) as record:
+        found, changes = update_tag_store(insight, matcher, store_f_name,
+                                          workers, shard_size)
+        insight['Course'] = found['Course']
+        insight['Status'] = found['Status']
+        insight['Tutor'] = found['Tutor']
+        record['rows_out'] = len(insight)
     # Remove Expired, Graduated and Withdrawn students if desired
-    if sample == 'Active':
-        insight['Tags'] = insight['Tags'].apply(remove_inactive)
-        insight = insight.drop(insight.index[insight['Tags'] == 
-                                             'Remove']) 
-    # Find status tag and save to column
-    insight['Tags'] = insight['Tags'].apply(extract_status_tag)
+    active = get_active_mask(found, sample, stats)
     # Remove Students not in the Student Database, if required
-    if keep_old: # Keep all students in Insightly records
-        tags = pd.merge(exist, insight, on='StudentID', how='right')
-        tags['Enrolment Code'] = tags['Enrolment Code'].fillna('N/A')
-    else: # Remove students not in the Student Database
-        tags = pd.merge(exist, insight, on='StudentID', how='inner')
-    headings = ['Enrolment Code', 'StudentID', 'First Name', 'Last Name',
-                'Tags']
-    tags = tags[headings]
-    # Save Master file
-    f_name = 'Status_Tags_{}.xls'.format(ft.generate_time_string())
-    tags.to_excel(f_name, index=False)
-    print('\nStatus_Tags has been saved to {}'.format(f_name))
-    ft.process_warning_log(warnings, warnings_to_process)
-
-
-def process_tutor_tag_extraction():
-    """Process tutor tag extraction.
+    with stats.stage('join', len(insight)) as record:
+        tags = join_students(exist, insight, keep_old, mask=active)
+        record['rows_out'] = len(tags)
+    # Save Master file and status changes
+    f_name = get_output_name('All_Tags', out_f_name, out_format)
+    with stats.stage('write', len(tags)):
+        write_table(tags, f_name, out_format)
+    print('\nAll_Tags has been saved to {}'.format(f_name))
+    if os.path.basename(out_f_name or '') == '':
+        changes_f_name = get_output_name('Status_Changes', out_f_name,
+                                         out_format)
+    else:
+        stem, extension = os.path.splitext(out_f_name)
+        changes_f_name = '{}_changes{}'.format(stem, extension)
+    with stats.stage('write', len(changes)):
+        write_table(changes, changes_f_name, out_format)
+    print('\nStatus_Changes has been saved to {}'.format(changes_f_name))
+    stats.finish(f_name, timings)
+    save_input_errors(errors, f_name)
+    save_warnings(diagnostics, f_name, interactive)
+    return [f_name, changes_f_name]
+
+
+def process_reconcile_extraction(sample=None, exist_f_name='',
+        insightly_f_name='', out_f_name='', out_format='',
+        cache_dir=CACHE_DIR, workers=1, shard_size=SHARD_SIZE,
+        match=None, timings=False, profile_stage='',
+        interactive=True):
+    """Process the comparison of the Student Database tags with Insightly.
+    
+    Extracts the status tag for each student in Insightly and compares it
+    with the Tag of each of their enrolments in the Student Database,
+    ignoring case. Only the enrolments where the two differ are saved.
+    Students that are in only one of the files are not compared.
+    
+    Args:
+        sample (str): (Optional) 'All' or 'Active' students in the Existing
+        Students file. If not provided, user will be prompted.
+        exist_f_name (str): (Optional) Existing Students file name. If not
+        provided, user will be prompted.
+        insightly_f_name (str): (Optional) Insightly Data file name. If not
+        provided, user will be prompted.
+        out_f_name (str): (Optional) Name of the file to save. If not
+        provided, a time stamped name is generated.
+        out_format (str): (Optional) Format of the file to save, one of
+        OUTPUT_FORMATS. If not provided, it is taken from the extension of
+        out_f_name, or DEFAULT_OUTPUT_FORMAT is used.
+        cache_dir (str): Folder used to cache the cleaned input data, or
+        None to always load the data from the files.
+        workers (int): Number of worker processes used to extract the tags.
+        shard_size (int): Number of students extracted by each worker
+        process at a time.
+        match (str): (Optional) 'token' to match keywords to whole tags, or
+        'substring' to find them anywhere in the Tags. If not provided, user
+        will be prompted.
+        timings (bool): True to print the time and memory used by each
+        stage and save them next to the output file.
+        profile_stage (str): (Optional) Name of a stage to profile with
+        cProfile and tracemalloc when timings are saved.
+        interactive (bool): False to skip the required files confirmation
+        and save warnings next to the output file instead of processing
+        them with the user.
     
-    Extracts the tutor tag for each student. Returns a DataFrame with the
-    extracted students.
+    Returns:
+        f_name (str): Name of the file that was saved.
     
     File structure (Existing students):
         EnrolmentPK, StudentID, CourseFK, TutorFK, StartDate, ExpiryDate,
@@ -719,105 +3176,418 @@ def process_tutor_tag_extraction():
     File structure (Insightly_Data):
         StudentID, First Name, Last Name, Tags.
         
-    File structure (tutors.txt):
-        First name of each tutor separated by a comma (no spaces).
-        
     File source (Existing students):
         Enrolments Table in Student Database.
-        
+    
     File source (Insightly_Data):
         Insightly Data Dump (using columns listed in File structure).
-    
-    File source (tutors.txt):
-        Tutors in Insightly (check Contact Tags in Contacts).
     """
-    warnings = ['\nProcessing Student Tutor Tag Extraction data Warnings:\n']
-    warnings_to_process = False
-    print('\nExtracting Student Tutor Tags.')
+    diagnostics = Diagnostics('Processing Tag Reconciliation data Warnings')
+    stats = RunStats(profile_stage)
+    errors = []
+    print('\nComparing Student Database Tags with Insightly.')
     # Confirm the required files are in place
-    required_files = ['Existing Students', 'Insightly Data', 'Tutor Names']
-    ad.confirm_files('Extracting Student Tutor Tags', required_files)
-    # Ask if want all students or only those in the Student Database
-    keep_old = get_old_response()
-    # Get sample to use - if do not want old students
-    if keep_old:
-        source = 'All Students Data'
-        sample = 'All'
-    else:
-        sample = get_sample()
-        source = '{} Students Data'.format(sample)
-    print('\nYou will need to load the {} file.'.format(source))
-    # Get name for 'Existing Students' Report data file and then load
-    exist_stud_data, to_add, warnings_to_add = load_data(source)
-    if to_add:
-        warnings_to_process = True
-        for line in warnings_to_add:
-            warnings.append(line)
-    # Get name for 'Insightly_Data' Report data file and then load
-    insightly_data, to_add, warnings_to_add = load_data('Insightly_Data_')
-    if to_add:
-        warnings_to_process = True
-        for line in warnings_to_add:
-            warnings.append(line)
-    # Load Tutors File
-    tutors = ft.load_headings('tutors.txt')
-    # Clean the Existing Student data and extract desired columns
-    exist_stud_clean = clean_exist_stud(exist_stud_data)
-    # Clean the Insightly data and extract desired columns
-    insightly_clean = clean_insightly(insightly_data)
-    # Create DataFrame for Existing students
-    headings = ['Enrolment Code', 'StudentID', 'Tag']
-    exist = pd.DataFrame(data = exist_stud_clean, columns = headings)
-    # Create DataFrame for Insightly Data
-    headings = ['StudentID', 'First Name', 'Last Name', 'Tags']
-    insight = pd.DataFrame(data = insightly_clean, columns = headings)
-    # Remove Expired, Graduated and Withdrawn students if desired
-    if sample == 'Active':
-        insight['Tags'] = insight['Tags'].apply(remove_inactive)
-        insight = insight.drop(insight.index[insight['Tags'] == 
-                                             'Remove'])
-    # Find tutor tag and save to column
-    insight['Tags'] = insight['Tags'].apply(extract_tutor_tag, args=(tutors,))
-    # Remove Students not in the Student Database, if required
-    if keep_old: # Keep all students in Insightly records
-        tags = pd.merge(exist, insight, on='StudentID', how='right')
-        tags['Enrolment Code'] = tags['Enrolment Code'].fillna('N/A')
-    else: # Remove students not in the Student Database
-        tags = pd.merge(exist, insight, on='StudentID', how='inner')
+    required_files = ['Existing Students', 'Insightly Data']
+    if interactive:
+        ad.confirm_files('Comparing Student Database Tags', required_files)
+    # Only students in the Student Database are compared
+    keep_old, sample, source, match = get_run_options(False, sample, match)
+    if exist_f_name in (None, ''):
+        print('\nYou will need to load the {} file.'.format(source))
+    # Load, check and clean the Existing Students and Insightly data
+    # at the same time
+    exist, insight, courses, tutors = load_inputs(
+            source, exist_f_name, insightly_f_name, '', '', cache_dir,
+            stats, diagnostics, errors)
+    matcher = get_tag_matcher(match=match)
+    with stats.stage('extract', len(insight)) as record:
+        found = classify_tags(insight['Tags'], matcher, workers, shard_size)
+        insight['Status'] = found['Status']
+        record['rows_out'] = len(insight)
     headings = ['Enrolment Code', 'StudentID', 'First Name', 'Last Name',
-                'Tags']
-    tags = tags[headings]
-    # Save Master file
-    f_name = 'Tutor_Tags_{}.xls'.format(ft.generate_time_string())
-    tags.to_excel(f_name, index=False)
-    print('\nTutor_Tags has been saved to {}'.format(f_name))
-    ft.process_warning_log(warnings, warnings_to_process)
-
-
-def remove_inactive(raw_data):
-    """Replace Contact tag for unwanted students.
+                'Tag', 'Status']
+    with stats.stage('join', len(insight)) as record:
+        tags = join_students(exist, insight, keep_old, headings)
+        record['rows_out'] = len(tags)
+    # Compare the whole columns at once, keeping only the differences
+    with stats.stage('compare', len(tags)) as record:
+        mismatched = get_tag_keys(tags['Tag']) != get_tag_keys(tags['Status'])
+        mismatches = tags[mismatched].reset_index(drop=True)
+        mismatches.columns = headings[:-2] + ['Database Tag',
+                                              'Insightly Status']
+        record['rows_out'] = len(mismatches)
+    print('\n{} of {} enrolments have a different Tag in the Student '
+          'Database and Insightly.'.format(len(mismatches), len(tags)))
+    f_name = get_output_name('Tag_Mismatches', out_f_name, out_format)
+    with stats.stage('write', len(mismatches)):
+        write_table(mismatches, f_name, out_format)
+    print('\nTag_Mismatches has been saved to {}'.format(f_name))
+    stats.finish(f_name, timings)
+    save_input_errors(errors, f_name)
+    save_warnings(diagnostics, f_name, interactive)
+    return f_name
+
+
+def process_status_tag_extraction(keep_old=None, sample=None, exist_f_name='',
+        insightly_f_name='', out_f_name='', out_format='',
+        courses_f_name='courses.txt', tutors_f_name='tutors.txt',
+        cache_dir=CACHE_DIR, workers=1, shard_size=SHARD_SIZE,
+        match=None, timings=False, profile_stage='',
+        interactive=True):
+    """Process status tag extraction.
+    
+    Extracts the status tag for each student and saves it in the Tags
+    column. See process_extraction for the arguments and the files used.
+    
+    Returns:
+        f_name (str): Name of the file that was saved.
+    """
+    return process_extraction(
+            'status', keep_old, sample, exist_f_name, insightly_f_name,
+            out_f_name, out_format, courses_f_name, tutors_f_name, cache_dir,
+            workers, shard_size, match, timings, profile_stage,
+            interactive=interactive)
+
+
+def process_streaming_extraction(keep_old=None, sample=None, exist_f_name='',
+        insightly_f_name='', out_f_name='', out_format='',
+        courses_f_name='courses.txt', tutors_f_name='tutors.txt', workers=1,
+        shard_size=SHARD_SIZE, match=None, timings=False,
+        profile_stage='', interactive=True):
+    """Process all tags for extraction from files too large for memory.
+    
+    Extracts the course, tutor and status tag for each student as with
+    process_all_tags_extraction, but streams the files a chunk at a time.
+    When students not in the Student Database are removed, rows are saved
+    in the order of the Insightly data rather than the Existing Students
+    data. See process_extraction for the arguments and the files used.
+    
+    Returns:
+        f_name (str): Name of the file that was saved.
+    """
+    return process_extraction(
+            'all', keep_old, sample, exist_f_name, insightly_f_name,
+            out_f_name, out_format, courses_f_name, tutors_f_name, None,
+            workers, shard_size, match, timings, profile_stage, stream=True,
+            interactive=interactive)
+
+
+def process_tutor_tag_extraction(keep_old=None, sample=None, exist_f_name='',
+        insightly_f_name='', out_f_name='', out_format='',
+        courses_f_name='courses.txt', tutors_f_name='tutors.txt',
+        cache_dir=CACHE_DIR, workers=1, shard_size=SHARD_SIZE,
+        match=None, timings=False, profile_stage='',
+        interactive=True):
+    """Process tutor tag extraction.
     
-    Replaces the Tags field with 'Remove' if the student contains
-    the tag 'Withdrawn', 'Graduated', 'Expired' or 'Transferred'. This allows
-    the students to be dropped from the data in a later step.
+    Extracts the tutor tag for each student and saves it in the Tags
+    column. See process_extraction for the arguments and the files used.
     
+    Returns:
+        f_name (str): Name of the file that was saved.
+    """
+    return process_extraction(
+            'tutor', keep_old, sample, exist_f_name, insightly_f_name,
+            out_f_name, out_format, courses_f_name, tutors_f_name, cache_dir,
+            workers, shard_size, match, timings, profile_stage,
+            interactive=interactive)
+
+
+def read_csv_columns(f_name, columns, chunksize=None):
+    """Return the chosen columns of a CSV file.
+
+    The file is memory mapped and parsed by the pandas C parser, and only
+    the chosen columns are kept, so no lists of rows are built. The heading
+    row is skipped. Columns are labelled by their position in the file, and
+    the values are not stripped.
+
     Args:
-        raw_data (str): String containing Contact tag data.
-        
+        f_name (str): Name of the file to be read.
+        columns (list): Positions of the columns to read, in order.
+        chunksize (int): (Optional) Number of rows to read at a time.
+
+    Returns:
+        report (DataFrame): The chosen columns, or an iterator of
+        DataFrames of chunksize rows if chunksize is given.
+    """
+    reader = pd.read_csv(f_name, usecols=columns, dtype=str,
+                         keep_default_na=False, memory_map=True,
+                         engine='c', chunksize=chunksize)
+    if chunksize is None:
+        reader.columns = columns
+        return reader
+
+    def label(chunks):
+        for chunk in chunks:
+            chunk.columns = columns
+            yield chunk
+
+    return label(reader)
+
+
+def report_import_times():
+    """Print how long the program took to start and its modules to import.
+
+    The slower modules are only imported when an extraction first uses
+    them, so each is imported here in turn and timed.
+
+    Returns:
+        0 once the times have been printed.
+    """
+    print('\nReady after {:.1f} ms'.format(
+            (time.perf_counter() - MODULE_STARTED) * 1000))
+    print('\n{:<24}{:>12}'.format('Module', 'Import (ms)'))
+    total = 0
+    for name in STARTUP_MODULES:
+        start = time.perf_counter()
+        try:
+            finish_import(sys.modules.get(name) or
+                          importlib.import_module(name))
+        except ImportError:
+            print('{:<24}{:>12}'.format(name, 'not installed'))
+            continue
+        elapsed = (time.perf_counter() - start) * 1000
+        total += elapsed
+        print('{:<24}{:>12.1f}'.format(name, elapsed))
+    print('{:<24}{:>12.1f}'.format('total', total))
+    return 0
+
+
+def run_batch(argv):
+    """Run one or more extractions from the command line without prompting.
+
+    Either a single job is described by the arguments or a list of jobs is
+    read from the manifest file. All jobs run in the same process, so the
+    modules only need to be imported once. With --serve, jobs are instead
+    accepted by the extraction service until it is stopped.
+
+    Args:
+        argv (list): Command line arguments, excluding the program name.
+
     Returns:
-        'Remove' if a tag 'Withdrawn', 'Graduated', 'Expired' or 'Transferred'
-        is found, the passed Tags otherwise.
-    """
-    if re.search('withdrawn', raw_data.lower()):
-        return 'Remove'
-    elif re.search('expired', raw_data.lower()):
-        return 'Remove'
-    elif re.search('graduated', raw_data.lower()):
-        return 'Remove'
-    elif re.search('transferred', raw_data.lower()):
-        return 'Remove'
+        0 if every job succeeded, 1 otherwise.
+    """
+    args = parse_args(argv)
+    if args.import_times:
+        return report_import_times()
+    if args.manifest in (None, '') or args.serve:
+        jobs = [{'mode': args.mode, 'existing': args.existing,
+                 'insightly': args.insightly, 'keep_old': args.keep_old,
+                 'sample': args.sample, 'output': args.output,
+                 'format': args.format, 'courses': args.courses,
+                 'tutors': args.tutors, 'summaries': args.summaries,
+                 'stream': args.stream, 'store': args.store,
+                 'history': args.history, 'dump_date': args.dump_date,
+                 'student': args.student, 'start': args.start,
+                 'end': args.end,
+                 'workers': args.workers, 'shard_size': args.shard_size,
+                 'match': args.match,
+                 'timings': args.timings or args.profile != '',
+                 'profile': args.profile}]
+    else:
+        try:
+            with open(args.manifest) as f:
+                jobs = json.load(f)
+        except (OSError, ValueError) as e:
+            print('\nManifest {} could not be read: {}'.format(args.manifest,
+                                                                e))
+            return 1
+        if (not isinstance(jobs, list) or
+                not all(isinstance(job, dict) for job in jobs)):
+            print('\nManifest {} must be a JSON list of jobs, each a JSON '
+                  'object, e.g. [{{"mode": "all", ...}}].'.format(
+                          args.manifest))
+            return 1
+    if args.no_cache:
+        cache_dir = None
+    else:
+        cache_dir = args.cache_dir
+    for job in jobs:
+        job.setdefault('cache_dir', cache_dir)
+    if args.serve:
+        # The arguments are the defaults for each job
+        return serve(jobs[0], args.port, args.output_dir)
+    failed = 0
+    for job in jobs:
+        try:
+            f_name = run_job(job)
+        except Exception as e:
+            failed += 1
+            print('\nJob {} failed: {}'.format(job, e))
+        else:
+            if isinstance(f_name, list):
+                f_name = ', '.join(f_name)
+            print('\nJob {} saved to {}'.format(job.get('mode'), f_name))
+    print('\n{} of {} jobs completed.'.format(len(jobs) - failed, len(jobs)))
+    if failed > 0:
+        return 1
     else:
-        return raw_data
+        return 0
+
+
+def run_job(job):
+    """Run a single extraction without prompting.
+
+    Args:
+        job (dict): Job options, with the keys mode, existing, insightly and
+        optionally keep_old, sample, output, format, courses, tutors,
+        workers, shard_size, match, timings, profile, cache_dir (None to
+        disable the cache), summaries (all and views modes only), stream
+        (status, tutor, course, all and views modes only), store
+        (incremental mode only) and history. The stream mode is the all
+        mode with stream set. The history mode only needs insightly,
+        which may be a pattern matching several dumps, and takes an
+        optional dump_date. The timeline mode needs student instead of the
+        input files, and the counts mode takes an optional start and end.
+
+    Returns:
+        f_name (str): Name of the file that was saved, or a list of names
+        for the views and incremental modes.
+    """
+    processes = {'incremental': process_incremental_extraction,
+                 'history': process_history_extraction,
+                 'reconcile': process_reconcile_extraction}
+    # Checked before extracting, rather than when the table is saved
+    out_format = job.get('format', '')
+    if out_format in (None, '') and job.get('output') not in (None, ''):
+        out_format = os.path.splitext(job['output'])[1].lstrip('.').lower()
+    if out_format not in (None, '') + OUTPUT_FORMATS:
+        raise ValueError('Unknown output format {}. Please use one of '
+                         '{}.'.format(out_format, ', '.join(OUTPUT_FORMATS)))
+    if out_format in (None, '') and os.path.basename(
+            job.get('output') or '') != '':
+        raise ValueError('No output format for {}. Please add an extension '
+                         'or give a format, one of {}.'.format(
+                                 job['output'], ', '.join(OUTPUT_FORMATS)))
+    if job.get('mode') in ('timeline', 'counts'):
+        return process_history_query(
+                job['mode'], job.get('student', ''), job.get('start', ''),
+                job.get('end', ''), job.get('history', HISTORY_STORE),
+                job.get('output', ''), job.get('format', ''))
+    if job.get('mode') not in MODES:
+        raise ValueError('Unknown mode {}'.format(job.get('mode')))
+    required = ('existing', 'insightly')
+    if job['mode'] == 'history':
+        required = ('insightly',)
+    for key in required:
+        if job.get(key) in (None, ''):
+            raise ValueError('No {} file given'.format(key))
+    keep_old = bool(job.get('keep_old', False))
+    sample = job.get('sample', 'All')
+    if sample not in ('All', 'Active'):
+        raise ValueError('Unknown sample {}'.format(sample))
+    match = job.get('match', DEFAULT_TAG_MATCH)
+    if match not in TAG_MATCH_MODES:
+        raise ValueError('Unknown tag match {}'.format(match))
+    if job['mode'] == 'history':
+        # A pattern adds every matching dump, in file name order
+        insightly_f_names = sorted(glob.glob(job['insightly']))
+        return process_history_extraction(
+                insightly_f_names or [job['insightly']],
+                job.get('dump_date', ''),
+                job.get('courses', 'courses.txt'),
+                job.get('tutors', 'tutors.txt'),
+                job.get('cache_dir', CACHE_DIR),
+                job.get('history', HISTORY_STORE),
+                int(job.get('workers', 1)),
+                int(job.get('shard_size', SHARD_SIZE)), match,
+                bool(job.get('timings', False)), job.get('profile', ''),
+                interactive=False)
+    options = {'keep_old': keep_old, 'sample': sample,
+               'exist_f_name': job['existing'],
+               'insightly_f_name': job['insightly'],
+               'out_f_name': job.get('output', ''),
+               'out_format': job.get('format', ''),
+               'courses_f_name': job.get('courses', 'courses.txt'),
+               'tutors_f_name': job.get('tutors', 'tutors.txt'),
+               'workers': int(job.get('workers', 1)),
+               'shard_size': int(job.get('shard_size', SHARD_SIZE)),
+               'match': match, 'timings': bool(job.get('timings', False)),
+               'profile_stage': job.get('profile', ''),
+               'cache_dir': job.get('cache_dir', CACHE_DIR),
+               'interactive': False}
+    if job['mode'] in EXTRACTIONS or job['mode'] == 'stream':
+        stream = job['mode'] == 'stream' or bool(job.get('stream', False))
+        mode = 'all' if job['mode'] == 'stream' else job['mode']
+        return process_extraction(
+                mode, summaries=bool(job.get('summaries', False)),
+                stream=stream, **options)
+    if job['mode'] == 'reconcile':
+        # Only the status of students in the Student Database is compared
+        for key in ('keep_old', 'courses_f_name', 'tutors_f_name'):
+            del options[key]
+    if job['mode'] == 'incremental':
+        options['store_f_name'] = job.get('store', TAG_STORE)
+    return processes[job['mode']](**options)
+
+
+def save_errors(errors, source, log_f_name=''):
+    """Save the errors identified in an input file to the error log.
+
+    Only the summary of the errors is sent to the error log.
+
+    Args:
+        errors (Diagnostics): Errors that have been identified in the data.
+        source (str): Name of the input file in the error log.
+        log_f_name (str): (Optional) Name of the file the details of every
+        error have been saved to, named in the summary.
+    """
+    if not errors:
+        return
+    summary = errors.summary()
+    if log_f_name not in (None, ''):
+        summary.append('\nDetails of every error have been saved to '
+                       '{}'.format(log_f_name))
+    ft.process_error_log(summary, source)
+
+
+def save_input_errors(errors, f_name):
+    """Save the errors identified in the input files of an extraction.
+
+    The summary and details of the errors in every input file are saved
+    next to the output file, and the summary for each input file is sent
+    to the error log, naming the file with the details.
+
+    Args:
+        errors (list): Source and errors of each input file, from
+        add_errors.
+        f_name (str): Name of the file that was saved by the extraction.
+    """
+    errors = sorted(((source, found) for source, found in errors if found),
+                    key=lambda error: error[0])
+    if not errors:
+        return
+    log_f_name = '{}_errors.txt'.format(os.path.splitext(f_name)[0])
+    for i, (source, found) in enumerate(errors):
+        found.write(log_f_name, 'a' if i else 'w')
+    for source, found in errors:
+        save_errors(found, source, log_f_name)
+
+
+def save_warnings(diagnostics, f_name, interactive=True):
+    """Process the warnings identified during an extraction.
+
+    The summary and details of every warning are saved next to the output
+    file. Only the summary is processed with the user, naming the file
+    with the details.
+
+    Args:
+        diagnostics (Diagnostics): Warnings that have been identified in the
+        data.
+        f_name (str): Name of the file that was saved by the extraction.
+        interactive (bool): False to only save the warnings next to the
+        output file, without processing them with the user.
+    """
+    summary = diagnostics.summary()
+    if diagnostics:
+        log_f_name = '{}_warnings.txt'.format(os.path.splitext(f_name)[0])
+        diagnostics.write(log_f_name)
+        summary.append('\nDetails of every warning have been saved to '
+                       '{}'.format(log_f_name))
+        if not interactive:
+            print('\nWarnings have been saved to {}'.format(log_f_name))
+    if interactive:
+        ft.process_warning_log(summary, bool(diagnostics))
 
 
 def sample_menu():
@@ -828,5 +3598,282 @@ def sample_menu():
     print('2: Active Students')
 
 
+def serve(defaults, port=SERVICE_PORT, output_dir=''):
+    """Run the extraction service until it is stopped.
+
+    The service keeps the modules imported, compiled matchers, the worker
+    pool and recently loaded input data between jobs, so each job only
+    pays for the work that has changed. A new token for the requests is
+    printed each time the service starts.
+
+    Args:
+        defaults (dict): Job options used when a job does not give them.
+        port (int): Port to listen on, on localhost only.
+        output_dir (str): (Optional) Folder that jobs save their files in.
+        Defaults to the current folder.
+
+    Returns:
+        0 once the service has stopped.
+    """
+    import http.server
+    import secrets
+    handler = type('ExtractionRequestHandler',
+                   (ExtractionHandler, http.server.BaseHTTPRequestHandler), {})
+    server = http.server.HTTPServer((SERVICE_HOST, port), handler)
+    server.defaults = defaults
+    server.output_dir = os.path.realpath(output_dir or os.getcwd())
+    server.token = secrets.token_urlsafe(32)
+    server.latencies = []
+    server.failed = 0
+    server.started = time.perf_counter()
+    MEMORY_CACHE.size = MEMORY_CACHE_ENTRIES
+    print('\nAccepting extraction jobs at http://{}:{}/jobs'.format(
+            SERVICE_HOST, server.server_port))
+    print('Files will be saved in {}'.format(server.output_dir))
+    print('Send this token in the {} header of each request:\n{}'.format(
+            SERVICE_TOKEN_HEADER, server.token))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    print('\nExtraction service stopped.')
+    return 0
+
+
+def strip_columns(frame):
+    """Return a copy of a table with whitespace stripped from every value.
+
+    Each column is stripped as a whole, and missing values become ''.
+
+    Args:
+        frame (DataFrame): Table of strings.
+
+    Returns:
+        frame (DataFrame): The stripped table.
+    """
+    return frame.apply(lambda column: column.fillna('').astype(str)
+                       .str.strip())
+
+
+def to_report_frame(report_data, columns):
+    """Return report data as a DataFrame with positional columns.
+
+    Args:
+        report_data (list): Report data, as a list of rows or a DataFrame.
+        columns (int): Number of columns expected in the report.
+
+    Returns:
+        report (DataFrame): The report data.
+    """
+    if isinstance(report_data, pd.DataFrame):
+        return report_data
+    report = pd.DataFrame(report_data, dtype=object)
+    if report.shape[1] < columns:
+        report = report.reindex(columns=range(columns)).astype(object)
+    return report
+
+
+def update_history_store(insight, found, dump_date, f_name,
+        history_f_name=HISTORY_STORE):
+    """Add the tags extracted from a dump to the Status History.
+
+    Any tags already stored for the date of the dump are replaced, naming
+    the file they were added from. A student that appears more than once
+    in the dump is stored once, with the tags of their last row.
+
+    Args:
+        insight (DataFrame): StudentID, First Name, Last Name and Tags for
+        each student.
+        found (DataFrame): Course, Status, Tutor and Inactive columns,
+        aligned with the index of insight.
+        dump_date (str): Date of the dump as YYYY-MM-DD.
+        f_name (str): Name of the Insightly Data file.
+        history_f_name (str): SQLite database holding the Status History.
+
+    Returns:
+        students (int): Number of students stored.
+    """
+    history = pd.DataFrame({
+            'StudentID': insight['StudentID'].to_numpy(),
+            'Course': found['Course'].to_numpy(),
+            'Tutor': found['Tutor'].to_numpy(),
+            'Status': found['Status'].to_numpy(),
+            'Inactive': found['Inactive'].to_numpy(dtype=np.int64)}
+            ).drop_duplicates('StudentID', keep='last')
+    counts = history['Status'].value_counts()
+    columns = ['Course', 'Tutor', 'Status']
+    connection = open_history_store(history_f_name)
+    try:
+        with connection:
+            # Give any new tag values a code, then store the codes
+            values = set()
+            for column in columns:
+                values.update(pd.unique(history[column]))
+            connection.executemany(
+                    'INSERT OR IGNORE INTO tag_values (Value) VALUES (?)',
+                    ((value,) for value in values))
+            codes = dict(connection.execute(
+                    'SELECT Value, Code FROM tag_values'))
+            for column in columns:
+                history[column] = history[column].map(codes)
+            row = connection.execute('SELECT DumpID, FileName FROM dumps '
+                                     'WHERE DumpDate = ?',
+                                     (dump_date,)).fetchone()
+            if row is None:
+                dump_id = connection.execute(
+                        'INSERT INTO dumps (DumpDate, FileName, Students) '
+                        'VALUES (?, ?, ?)',
+                        (dump_date, f_name, len(history))).lastrowid
+            else:
+                dump_id = row[0]
+                print('\nReplacing the Status History for {} added from '
+                      '{}.'.format(dump_date, row[1]))
+                connection.execute('DELETE FROM history WHERE DumpID = ?',
+                                   (dump_id,))
+                connection.execute('DELETE FROM status_counts WHERE '
+                                   'DumpID = ?', (dump_id,))
+                connection.execute('UPDATE dumps SET FileName = ?, '
+                                   'Students = ? WHERE DumpID = ?',
+                                   (f_name, len(history), dump_id))
+            # Inserted in StudentID order, to follow the layout of the table
+            history = history.sort_values('StudentID')
+            connection.executemany(
+                    'INSERT INTO history VALUES (?, ?, ?, ?, ?, ?)',
+                    zip(history['StudentID'].tolist(),
+                        itertools.repeat(dump_id),
+                        history['Course'].tolist(),
+                        history['Tutor'].tolist(),
+                        history['Status'].tolist(),
+                        history['Inactive'].tolist()))
+            connection.executemany(
+                    'INSERT INTO status_counts VALUES (?, ?, ?)',
+                    ((dump_id, status, int(students))
+                     for status, students in counts.items()))
+    finally:
+        connection.close()
+    return len(history)
+
+
+def update_tag_store(insight, matcher, store_f_name=TAG_STORE, workers=1,
+        shard_size=SHARD_SIZE):
+    """Return the tags for each student, only extracting changed students.
+
+    The tag store holds a hash of the Tags and the extracted tags for each
+    StudentID from the previous run. Students whose Tags hash matches are
+    given the stored tags, and only new or changed students are extracted.
+    If the courses or tutors have changed since the previous run, every
+    student is extracted. The store is then replaced with the current data.
+
+    Args:
+        insight (DataFrame): StudentID, First Name, Last Name and Tags for
+        each student.
+        matcher (TagMatcher): Matcher for the courses and tutors.
+        store_f_name (str): SQLite database holding the stored tags.
+        workers (int): Number of worker processes used to extract the tags.
+        shard_size (int): Number of students extracted by each worker
+        process at a time.
+
+    Returns:
+        found (DataFrame): Course, Status, Tutor and Inactive columns,
+        aligned with the index of insight.
+        changes (DataFrame): StudentID, First Name, Last Name, Previous
+        Status and Status for each student whose status has changed.
+    """
+    columns = ['Course', 'Status', 'Tutor', 'Inactive']
+    # Identifies the courses, tutors and way of matching the stored tags
+    # were extracted with
+    signature = hashlib.sha256(json.dumps(
+            [list(matcher.values['Course']), list(matcher.values['Tutor']),
+             matcher.match]).encode('utf-8')).hexdigest()
+    current = pd.DataFrame({
+            'StudentID': insight['StudentID'].to_numpy(),
+            'TagsHash': pd.util.hash_pandas_object(
+                    insight['Tags'], index=False).to_numpy().astype(
+                    np.int64)}, index=insight.index)
+    connection = sqlite3.connect(store_f_name)
+    try:
+        connection.execute('CREATE TABLE IF NOT EXISTS settings '
+                           '(Name TEXT PRIMARY KEY, Value TEXT)')
+        connection.execute('CREATE TABLE IF NOT EXISTS tags '
+                           '(StudentID TEXT PRIMARY KEY, TagsHash INTEGER, '
+                           'Course TEXT, Status TEXT, Tutor TEXT, '
+                           'Inactive INTEGER)')
+        row = connection.execute('SELECT Value FROM settings WHERE Name = ?',
+                                 ('signature',)).fetchone()
+        stored = pd.read_sql_query('SELECT * FROM tags', connection)
+        stored['Inactive'] = stored['Inactive'].astype(bool)
+        previous = current.merge(stored, on='StudentID', how='left',
+                                 suffixes=('', '_stored'))
+        previous.index = insight.index
+        unchanged = previous['TagsHash'] == previous['TagsHash_stored']
+        if row is None or row[0] != signature:
+            unchanged[:] = False
+        found = previous.loc[:, columns].copy()
+        changed = ~unchanged
+        if changed.any():
+            found.loc[changed, columns] = classify_tags(
+                    insight.loc[changed, 'Tags'], matcher, workers,
+                    shard_size)[columns]
+        found = matcher.to_categorical(found)
+        found['Inactive'] = found['Inactive'].astype(bool)
+        print('\nExtracted tags for {} new or changed students, reused {}.'
+              .format(int(changed.sum()), int(unchanged.sum())))
+        # Status changes, including new and removed students
+        latest = pd.DataFrame({
+                'StudentID': insight['StudentID'].to_numpy(),
+                'First Name': insight['First Name'].to_numpy(),
+                'Last Name': insight['Last Name'].to_numpy(),
+                'Status': found['Status'].to_numpy()}).drop_duplicates(
+                'StudentID', keep='last')
+        changes = latest.merge(
+                stored[['StudentID', 'Status']].rename(
+                        columns={'Status': 'Previous Status'}),
+                on='StudentID', how='outer')
+        changes = changes[changes['Status'] != changes['Previous Status']]
+        changes = changes[['StudentID', 'First Name', 'Last Name',
+                           'Previous Status', 'Status']].fillna('')
+        # Replace the stored tags with the current data
+        store = pd.concat([current, found], axis=1).drop_duplicates(
+                'StudentID', keep='last')
+        store['Inactive'] = store['Inactive'].astype(int)
+        with connection:
+            connection.execute('DELETE FROM tags')
+            connection.executemany(
+                    'INSERT INTO tags VALUES (?, ?, ?, ?, ?, ?)',
+                    store[['StudentID', 'TagsHash'] + columns].itertuples(
+                            index=False, name=None))
+            connection.execute('INSERT OR REPLACE INTO settings VALUES '
+                               '(?, ?)', ('signature', signature))
+    finally:
+        connection.close()
+    return found, changes.reset_index(drop=True)
+
+
+def write_table(table, f_name, out_format=''):
+    """Save a table to disk.
+
+    The table is passed to a TableWriter in chunks of WRITE_CHUNK_SIZE rows,
+    so the writer never holds a second copy of the whole table.
+
+    Args:
+        table (DataFrame): Table to be saved.
+        f_name (str): Name of the file to save.
+        out_format (str): (Optional) Format of the file, one of
+        OUTPUT_FORMATS. If not provided, it is taken from the extension of
+        f_name.
+    """
+    writer = TableWriter(f_name, out_format)
+    try:
+        writer.write(table.iloc[:WRITE_CHUNK_SIZE])
+        for i in range(WRITE_CHUNK_SIZE, len(table), WRITE_CHUNK_SIZE):
+            writer.write(table.iloc[i:i + WRITE_CHUNK_SIZE])
+    finally:
+        writer.close()
+
+
 if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        sys.exit(run_batch(sys.argv[1:]))
     main()
\ No newline at end of file
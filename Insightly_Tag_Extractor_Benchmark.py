@@ -0,0 +1,324 @@
+# -*- coding: utf-8 -*-
+# Insightly Tag Extractor Benchmark
+# Generates synthetic Insightly Data and Existing Students files and times
+# each stage of the tag extraction against them
+# Results are saved as a JSON report that can be compared across runs
+
+# Usage:
+# python Insightly_Tag_Extractor_Benchmark.py --sizes 10000 100000
+# python Insightly_Tag_Extractor_Benchmark.py --compare old.json new.json
+# python Insightly_Tag_Extractor_Benchmark.py --check-join
+
+
+import Insightly_Tag_Extractor as ite
+import custtools.filetools as ft
+import argparse
+import csv
+import json
+import os
+import platform
+import random
+import sys
+import time
+import pandas as pd
+
+
+# Status tags as they appear in Insightly
+STATUS_NAMES = ('Green', 'Orange', 'Red', 'Black', 'Purple', 'Suspended',
+                'Withdrawn', 'Graduated', 'Expired', 'On Hold', 'Cancelled',
+                'Transferred')
+
+# Other tags found on Contacts that are not extracted
+OTHER_TAGS = ('Newsletter', 'Facebook Lead', 'Referral', 'Alumni Event',
+              'Payment Plan', 'Credit Card', 'Scholarship', 'VIP')
+
+# StudentIDs of the Existing Students and Insightly data joined by
+# --check-join, covering blank, non-numeric and repeated StudentIDs
+JOIN_CASES = (('numeric', ['100', '101', '102'], ['102', '100', '999']),
+              ('blank existing', ['100', '', '102'], ['102', '100', '999']),
+              ('blank insightly', ['100', '101', '102'], ['102', '', '100']),
+              ('text existing', ['100', 'A1', '102'], ['102', '100', 'A1']),
+              ('text insightly', ['100', '101', '102'], ['A1', '102', '100']),
+              ('leading zeros', ['0100', '100', '7'], ['100', '0100', '07']),
+              ('repeated existing', ['100', '100', '102'], ['102', '100']),
+              ('blank both', ['', '100'], ['', '100', '101']))
+
+
+def check_join():
+    """Check that joining students gives the same rows as pd.merge.
+
+    Each of the JOIN_CASES is joined with and without old students, with
+    the StudentKey column added as when the data is loaded, and compared
+    with the merge used by earlier versions.
+
+    Returns:
+        failed (list): Names of the cases that did not match.
+    """
+    headings = ['Enrolment Code', 'StudentID', 'First Name', 'Last Name',
+                'Course', 'Tutor', 'Status']
+    failed = []
+    for name, exist_ids, insightly_ids in JOIN_CASES:
+        exist = pd.DataFrame({
+                'Enrolment Code': ['E{}'.format(i) for i in
+                                   range(len(exist_ids))],
+                'StudentID': exist_ids, 'Tag': 'Green'})
+        insight = pd.DataFrame({
+                'StudentID': insightly_ids,
+                'First Name': ['First{}'.format(i) for i in
+                               range(len(insightly_ids))],
+                'Last Name': 'Last', 'Course': 'C1', 'Tutor': 'Ann',
+                'Status': 'Green'})
+        ite.add_student_keys(exist)
+        ite.add_student_keys(insight)
+        for keep_old in (False, True):
+            how = 'right' if keep_old else 'inner'
+            expected = pd.merge(exist.drop(columns='StudentKey',
+                                           errors='ignore'),
+                                insight.drop(columns='StudentKey',
+                                             errors='ignore'),
+                                on='StudentID', how=how)
+            if keep_old:
+                expected['Enrolment Code'] = expected[
+                        'Enrolment Code'].fillna('N/A')
+            expected = expected[headings].astype(object)
+            joined = ite.join_students(exist, insight, keep_old, headings)
+            try:
+                pd.testing.assert_frame_equal(
+                        joined.astype(object).reset_index(drop=True),
+                        expected.reset_index(drop=True))
+            except AssertionError:
+                failed.append('{} (keep_old={})'.format(name, keep_old))
+    return failed
+
+
+def compare_reports(old_f_name, new_f_name):
+    """Print the change in time for each stage between two reports.
+
+    Args:
+        old_f_name (str): Name of the earlier JSON report.
+        new_f_name (str): Name of the later JSON report.
+    """
+    with open(old_f_name) as f:
+        old = {run['rows']: run['stages'] for run in json.load(f)['runs']}
+    with open(new_f_name) as f:
+        new = {run['rows']: run['stages'] for run in json.load(f)['runs']}
+    for rows in sorted(set(old) & set(new)):
+        print('\n{} rows:'.format(rows))
+        print('{:<26}{:>12}{:>12}{:>10}'.format('Stage', 'Old (s)',
+                                                'New (s)', 'Ratio'))
+        for stage, new_time in new[rows].items():
+            old_time = old[rows].get(stage)
+            if old_time in (None, 0):
+                ratio = ''
+            else:
+                ratio = '{:.2f}x'.format(new_time / old_time)
+            if old_time is None:
+                old_time = ''
+            else:
+                old_time = '{:.4f}'.format(old_time)
+            print('{:<26}{:>12}{:>12.4f}{:>10}'.format(stage, old_time,
+                                                       new_time, ratio))
+
+
+def generate_data(folder, rows, courses=300, tutors=30, seed=0):
+    """Generate synthetic input files for a benchmark run.
+
+    Writes an Insightly Data file with rows students, an Existing Students
+    file with an enrolment for most of them, and the courses.txt and
+    tutors.txt files. Rows are written as they are generated, so files of
+    any size can be created.
+
+    Args:
+        folder (str): Folder to save the files to.
+        rows (int): Number of students in the Insightly Data file.
+        courses (int): Number of course codes.
+        tutors (int): Number of tutors.
+        seed (int): Seed for the random number generator.
+
+    Returns:
+        f_names (dict): Names of the files, keyed by 'insightly', 'existing',
+        'courses' and 'tutors'.
+    """
+    rng = random.Random(seed)
+    os.makedirs(folder, exist_ok=True)
+    course_codes = ['{}{:03d}'.format(rng.choice(('BUS', 'ACC', 'MKT', 'HRM',
+                    'ITC')), i) for i in range(courses)]
+    tutor_names = ['Tutor{}'.format(chr(65 + i % 26) * (1 + i // 26))
+                   for i in range(tutors)]
+    f_names = {
+        'insightly': os.path.join(folder, 'Insightly_Data_{}.csv'.format(
+                rows)),
+        'existing': os.path.join(folder, 'Existing_Students_{}.csv'.format(
+                rows)),
+        'courses': os.path.join(folder, 'courses.txt'),
+        'tutors': os.path.join(folder, 'tutors.txt'),
+        }
+    with open(f_names['courses'], 'w') as f:
+        f.write(','.join(course_codes))
+    with open(f_names['tutors'], 'w') as f:
+        f.write(','.join(tutor_names))
+    valid_tags = list(ite.VALID_TAGS)
+    with open(f_names['insightly'], 'w', newline='') as insightly, \
+            open(f_names['existing'], 'w', newline='') as existing:
+        insightly_writer = csv.writer(insightly)
+        existing_writer = csv.writer(existing)
+        insightly_writer.writerow(['StudentID', 'First Name', 'Last Name',
+                                   'Tags', 'Email', 'Phone', 'Owner',
+                                   'Date Created'])
+        existing_writer.writerow(['EnrolmentPK', 'StudentID', 'CourseFK',
+                                  'TutorFK', 'StartDate', 'ExpiryDate',
+                                  'Status', 'Tag'])
+        for i in range(rows):
+            student_id = str(100000 + i)
+            tags = rng.sample(OTHER_TAGS, rng.randint(0, 3))
+            tags.append(rng.choice(STATUS_NAMES))
+            tags.append(rng.choice(course_codes))
+            if rng.random() < 0.9:
+                tags.append(rng.choice(tutor_names))
+            rng.shuffle(tags)
+            insightly_writer.writerow([
+                    student_id, 'First{}'.format(i), 'Last{}'.format(i),
+                    ', '.join(tags), 'student{}@example.com'.format(i), '',
+                    'Admin', '2018-01-01'])
+            # Most students are in the Student Database
+            if rng.random() < 0.8:
+                existing_writer.writerow([
+                        'E{}'.format(i), student_id, rng.choice(course_codes),
+                        rng.choice(tutor_names), '2018-01-01', '2019-01-01',
+                        'Active', rng.choice(valid_tags).title()])
+    return f_names
+
+
+def parse_args(argv):
+    """Return the parsed command line arguments.
+
+    Args:
+        argv (list): Command line arguments, excluding the program name.
+
+    Returns:
+        args (Namespace): Parsed arguments.
+    """
+    parser = argparse.ArgumentParser(
+            description='Benchmark the Insightly Tag Extractor against '
+            'synthetic data.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000],
+                        help='Numbers of students to benchmark.')
+    parser.add_argument('--folder', default='benchmark_data',
+                        help='Folder for the generated data.')
+    parser.add_argument('--output', default='',
+                        help='Name of the JSON report to save.')
+    parser.add_argument('--format', default='csv', choices=ite.OUTPUT_FORMATS,
+                        help='Format used for the write stage.')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of worker processes for extraction.')
+    parser.add_argument('--match', default=ite.DEFAULT_TAG_MATCH,
+                        choices=ite.TAG_MATCH_MODES,
+                        help='How keywords are matched to the Tags.')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Seed for the generated data.')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'),
+                        help='Compare two reports instead of running.')
+    parser.add_argument('--check-join', action='store_true',
+                        help='Check joined students against pd.merge '
+                        'instead of running.')
+    return parser.parse_args(argv)
+
+
+def run_benchmark(f_names, out_format='csv', workers=1,
+                  match=ite.DEFAULT_TAG_MATCH):
+    """Return the time taken by each stage of an extraction.
+
+    Args:
+        f_names (dict): Names of the generated files.
+        out_format (str): Format used for the write stage.
+        workers (int): Number of worker processes for extraction.
+        match (str): 'token' to match keywords to whole tags, or
+        'substring' to find them anywhere in the Tags.
+
+    Returns:
+        stages (dict): Seconds taken by each stage, in the order run.
+    """
+    # Stages are named after the function they time, and the data or tags
+    # that it is used for
+    stages = {}
+
+    def timed(stage, function, *args):
+        start = time.perf_counter()
+        result = function(*args)
+        stages[stage] = time.perf_counter() - start
+        return result
+
+    exist_data = timed('read_csv_columns_existing', ite.read_csv_columns,
+                       f_names['existing'], [0, 1, 6, 7])
+    insightly_data = timed('read_csv_columns_insightly',
+                           ite.read_csv_columns, f_names['insightly'],
+                           [0, 1, 2, 3])
+    timed('check_existing_students', ite.check_existing_students,
+          exist_data.reindex(columns=range(8)))
+    timed('check_insightly', ite.check_insightly, insightly_data)
+    exist = timed('strip_columns_existing', ite.strip_columns,
+                  exist_data[[0, 1, 7]])
+    insight = timed('strip_columns_insightly', ite.strip_columns,
+                    insightly_data)
+    exist.columns = ['Enrolment Code', 'StudentID', 'Tag']
+    insight.columns = ['StudentID', 'First Name', 'Last Name', 'Tags']
+    courses = tuple(ft.load_headings(f_names['courses']))
+    tutors = tuple(ft.load_headings(f_names['tutors']))
+    tags = insight['Tags']
+    timed('classify_tags_status', ite.classify_tags, tags,
+          ite.get_tag_matcher(match=match), workers)
+    timed('classify_tags_tutor', ite.classify_tags, tags,
+          ite.get_tag_matcher(tutors=tutors, match=match), workers)
+    timed('classify_tags_course', ite.classify_tags, tags,
+          ite.get_tag_matcher(courses=courses, match=match), workers)
+    found = timed('classify_tags_all', ite.classify_tags, tags,
+                  ite.get_tag_matcher(courses, tutors, match), workers)
+    insight['Course'] = found['Course']
+    insight['Status'] = found['Status']
+    insight['Tutor'] = found['Tutor']
+    joined = timed('join_students', ite.join_students, exist, insight, True)
+    out_f_name = os.path.join(os.path.dirname(f_names['insightly']),
+                              'All_Tags_benchmark.{}'.format(out_format))
+    timed('write_table', ite.write_table, joined, out_f_name, out_format)
+    stages['total'] = sum(stages.values())
+    return stages
+
+
+def main(argv):
+    args = parse_args(argv)
+    if args.compare:
+        compare_reports(*args.compare)
+        return 0
+    if args.check_join:
+        failed = check_join()
+        for name in failed:
+            print('Join does not match pd.merge: {}'.format(name))
+        print('\n{} of {} join checks passed.'.format(
+                2 * len(JOIN_CASES) - len(failed), 2 * len(JOIN_CASES)))
+        return 1 if failed else 0
+    report = {'created': time.strftime('%Y-%m-%d %H:%M:%S'),
+              'python': platform.python_version(),
+              'pandas': pd.__version__, 'platform': platform.platform(),
+              'workers': args.workers, 'format': args.format,
+              'match': args.match, 'runs': []}
+    for rows in args.sizes:
+        print('\nGenerating {} students.'.format(rows))
+        f_names = generate_data(args.folder, rows, seed=args.seed)
+        print('Running benchmark for {} students.'.format(rows))
+        stages = run_benchmark(f_names, args.format, args.workers,
+                               args.match)
+        for stage, seconds in stages.items():
+            print('{:<26}{:>10.4f} s'.format(stage, seconds))
+        report['runs'].append({'rows': rows, 'stages': stages})
+    if args.output in (None, ''):
+        f_name = 'Benchmark_{}.json'.format(ft.generate_time_string())
+    else:
+        f_name = args.output
+    with open(f_name, 'w') as f:
+        json.dump(report, f, indent=2)
+    print('\nBenchmark report has been saved to {}'.format(f_name))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))